@@ -1 +1 @@
-from .data_analyst import data_analyst
+from .data_analyst import data_analyst, data_analyst_stream
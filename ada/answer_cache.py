@@ -0,0 +1,175 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+from loguru import logger
+import json
+import math
+import re
+from ada import db_cache
+from ada.config import config
+from ada.schema_index import tokenize
+
+# Words that do not change what is asked for in a question about data
+STOPWORDS = {
+    "a", "all", "an", "and", "are", "by", "can", "did", "do", "does", "each", "for",
+    "give", "has", "have", "how", "i", "in", "is", "it", "list", "me", "of", "on",
+    "per", "please", "show", "tell", "the", "their", "there", "this", "to", "was",
+    "we", "were", "what", "which", "with", "you",
+}  # fmt: skip
+# Abbreviations replaced by the word they stand for
+ABBREVIATIONS = {
+    "avg": "average",
+    "mean": "average",
+    "num": "number",
+    "nr": "number",
+    "qty": "quantity",
+    "pct": "percentage",
+    "percent": "percentage",
+    "yr": "year",
+    "yearly": "year",
+    "annual": "year",
+    "monthly": "month",
+    "max": "maximum",
+    "highest": "maximum",
+    "min": "minimum",
+    "lowest": "minimum",
+    "cnt": "count",
+}
+
+# Words for negation, direction and comparison, which reverse the answer while
+# barely changing the question. Questions only match if they have the same.
+KEY_WORDS = {
+    "not", "no", "never", "without", "none", "nor", "except", "excluding",
+    "ascending", "asc", "descending", "desc", "increasing", "increase",
+    "decreasing", "decrease", "rising", "falling", "growth", "decline", "up",
+    "down", "most", "least", "more", "less", "fewer", "fewest", "maximum",
+    "minimum", "top", "bottom", "best", "worst", "largest", "smallest",
+    "biggest", "greater", "greatest", "higher", "lower", "above", "below",
+    "over", "under", "before", "after", "first", "last", "oldest", "newest",
+    "earliest", "latest", "longest", "shortest",
+}  # fmt: skip
+
+# Words found in only one of two questions must be spelled this similarly to a
+# word of the other question, so "colour" matches "color" but "uk" never "usa"
+MIN_SPELLING_SIMILARITY = 0.8
+
+# Stopwords and key words as returned by `tokenize`, which removes plural s
+_STOP_TERMS = set(tokenize(" ".join(STOPWORDS)))
+_KEY_TERMS = set(tokenize(" ".join(KEY_WORDS)))
+
+
+class AnswerCache:
+    """Responses of the data analyst keyed by the question and a fingerprint of the
+    dataset. A question is answered from the cache when a question about the same
+    dataset is at least `threshold` similar to it. Questions are compared by the
+    cosine similarity of the character trigrams of their normalized words, and
+    only match when they contain the same numbers and the same words for
+    negation, direction and comparison (`KEY_WORDS`), so "top 5" never matches
+    "top 10" and "ascending" never matches "descending". Every other word must
+    also be in both questions, up to abbreviations and spelling, since a single
+    word such as a country barely changes the similarity of a long question.
+    Answers older than `ttl` seconds are ignored."""
+
+    def __init__(
+        self, threshold: float = 0.9, ttl: float = 86_400, max_candidates: int = 1_000
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_candidates = max_candidates
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.threshold)
+
+    def get(self, question: str, fingerprint: str) -> dict:
+        """Stored response to the most similar question or None"""
+        normalized = normalize_question(question)
+        vector = _trigrams(normalized)
+        required = _required_terms(normalized)
+        since = datetime.utcnow() - timedelta(seconds=self.ttl)
+        best, best_score = None, 0
+        for answer in db_cache.crud_answer.list_answers(
+            fingerprint, since, limit=self.max_candidates
+        ):
+            other = answer.normalized_question
+            if _required_terms(other) != required or not _same_words(normalized, other):
+                continue
+            score = _cosine(vector, _trigrams(other))
+            if score > best_score:
+                best, best_score = answer, score
+        if best is None or best_score < self.threshold:
+            self.misses += 1
+            return None
+        self.hits += 1
+        db_cache.crud_answer.record_hit(best.id)
+        logger.info(f"Answered {question!r} as {best.question!r} ({best_score:.2f})")
+        return json.loads(best.response)
+
+    def set(self, question: str, fingerprint: str, response: dict) -> None:
+        """Store a json serializable response to the question"""
+        db_cache.crud_answer.create(
+            db_cache.Answer(
+                fingerprint=fingerprint,
+                question=question,
+                normalized_question=normalize_question(question),
+                response=json.dumps(response),
+                created_at=datetime.utcnow(),
+            )
+        )
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses)
+
+
+def normalize_question(question: str) -> str:
+    """Lower case words of the question without stopwords and with abbreviations
+    spelled out"""
+    question = re.sub(r"n't\b", " not", question.lower())
+    question = re.sub(r"'s\b", "", question)
+    words = [ABBREVIATIONS.get(word, word) for word in tokenize(question)]
+    return " ".join(word for word in words if word not in _STOP_TERMS)
+
+
+def _trigrams(text: str) -> Counter:
+    return Counter(
+        padded[i : i + 3]
+        for padded in (f" {word} " for word in text.split())
+        for i in range(len(padded) - 2)
+    )
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    dot = sum(count * b[gram] for gram, count in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values()) * sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def _required_terms(text: str) -> list[str]:
+    """Numbers and key words, which must be equal for questions to match"""
+    return sorted(term for term in text.split() if term.isdigit() or term in _KEY_TERMS)
+
+
+def _same_words(a: str, b: str) -> bool:
+    """Whether every word found in only one of the normalized questions is a
+    spelling of a word found only in the other"""
+    words_a, words_b = set(a.split()), set(b.split())
+    only_a, only_b = words_a - words_b, words_b - words_a
+    return all(_has_spelling(word, only_b) for word in only_a) and all(
+        _has_spelling(word, only_a) for word in only_b
+    )
+
+
+def _has_spelling(word: str, others: set[str]) -> bool:
+    return any(
+        SequenceMatcher(None, word, other).ratio() >= MIN_SPELLING_SIMILARITY
+        for other in others
+    )
+
+
+# A threshold of 0 disables the cache
+answer_cache = AnswerCache(
+    threshold=float(config.get("ANSWER_CACHE_THRESHOLD", 0)),
+    ttl=float(config.get("ANSWER_CACHE_TTL", 86_400)),
+)
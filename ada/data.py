@@ -1,52 +1,362 @@
 from abc import abstractmethod
+from typing import Callable, Iterator
 import pandas as pd
 from pathlib import Path
 import duckdb
+import sqlalchemy
 import gc
 import os
-import pickle
+import json
+import hashlib
 import tempfile
+import threading
+import time
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from loguru import logger
+from ada.config import config
+from ada.locks import file_lock
+from ada.schema_index import SchemaIndex, search_terms
+from ada.tracing import span
+from ada.result_cache import result_cache
+from ada.result_cache import is_query
+import pyarrow as pa
+import math
+import re
+
+# File types duckdb can read natively and the table function used to read them
+DUCKDB_READERS = {
+    "csv": "read_csv_auto",
+    "tsv": "read_csv_auto",
+    "txt": "read_csv_auto",
+    "parquet": "read_parquet",
+    "json": "read_json_auto",
+    "jsonl": "read_json_auto",
+    "ndjson": "read_json_auto",
+}
+MANIFEST_FILENAME = "data_fetcher.json"
+LOCK_FILENAME = "data_fetcher.lock"
+MANIFEST_VERSION = 3
+
+# Text columns with at most this many distinct values are described by their
+# most frequent values, of which at most TOP_VALUES are kept
+MAX_CATEGORIES = 50
+TOP_VALUES = 10
+# Longest min, max or top value shown in the schema description
+MAX_VALUE_CHARS = 40
+# Distinct values are counted exactly in tables with at most this many rows, in
+# larger tables the approximate count of SUMMARIZE is used
+EXACT_DISTINCT_MAX_ROWS = 1_000_000
+
+# Default guardrails for queries, which can be overridden per fetcher
+QUERY_LIMITS = dict(
+    memory_limit=config.get("DUCKDB_MEMORY_LIMIT"),
+    threads=config.get("DUCKDB_THREADS"),
+    timeout=float(config.get("QUERY_TIMEOUT", 60)),
+    max_estimated_rows=int(config.get("QUERY_MAX_ESTIMATED_ROWS", 100_000_000)),
+    max_result_rows=int(config.get("QUERY_MAX_RESULT_ROWS", 1_000_000)),
+)
 
 
 class DataFetcher:
+    """Describe tables and run sql queries on them. Fetchers implement the schema
+    lookup and the query execution, the rest is shared."""
+
+    # Table -> statistics of its rows and columns, see `Files._column_stats`
+    column_stats = {}
+
+    @property
+    def data_version(self) -> str:
+        """Fingerprint of the data, which changes whenever the data may have
+        changed. None if changes to the data cannot be detected."""
+        return self.schema_version
+
+    @abstractmethod
+    def get_schema(self, tables: list[str] = None) -> list[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def exec_sql_arrow(
+        self, sql: str, use_cache: bool = True, limit: int = None
+    ) -> pa.Table:
+        raise NotImplementedError
+
     @abstractmethod
-    def get_tables_info(self, tables: list[str] = None) -> str:
+    def explain(self, sql: str) -> float:
+        """Validate a query without running it and return the number of rows it is
+        estimated to produce, or math.inf if the database gives no estimate"""
         raise NotImplementedError
 
     @abstractmethod
     def run_sql_query(self, table_names) -> str:
         raise NotImplementedError
 
+    def get_tables_info(self, tables: list[str] = None, stats: bool = True) -> str:
+        """Description of the tables for prompts. With `stats` the row counts and
+        the value ranges, distinct counts and most frequent values of the columns
+        are included where they were computed."""
+        info = ""
+        for table in self.get_schema(tables):
+            table_stats = self.column_stats.get(table["table"]) if stats else None
+            if not table_stats:
+                info += (
+                    f"Table '{table['table']}' has columns: "
+                    + ", ".join(
+                        f"{col['name']} ({col['type']})" for col in table["columns"]
+                    )
+                    + ".\n"
+                )
+                continue
+            columns = table_stats["columns"]
+            info += (
+                f"Table '{table['table']}' has {table_stats['num_rows']} rows and "
+                "columns: "
+                + ", ".join(
+                    _describe_column(col, columns.get(col["name"]))
+                    for col in table["columns"]
+                )
+                + ".\n"
+            )
+        return info
+
+    def relevant_tables(self, question: str, k: int) -> list[str]:
+        """The k tables most relevant to the question"""
+        if len(self.tables) <= k:
+            return self.tables
+        return self.schema_index.rank(question, k)
+
+    def exec_sql(
+        self, sql: str, use_cache: bool = True, limit: int = None
+    ) -> pd.DataFrame:
+        return self.exec_sql_arrow(sql, use_cache=use_cache, limit=limit).to_pandas()
+
+    def preview(self, sql: str, n_rows: int = 5) -> dict:
+        """First rows of the result of a query and a summary with the number of
+        rows and the min, max and null count of each column. Both are computed by
+        the database, so the full result is never materialized. A result of fewer
+        than `n_rows` rows is complete in the first rows, so the query is not run
+        again for the summary and the columns are None."""
+        head = self.exec_sql_arrow(sql, limit=n_rows)
+        if head.num_rows < n_rows:
+            return dict(head=head, num_rows=head.num_rows, columns=None)
+        columns = [
+            field.name for field in head.schema if not pa.types.is_nested(field.type)
+        ]
+        aggregates = ["count(*)"] + [
+            f"min({col}), max({col}), count(*) - count({col})"
+            for col in map(self._quote, columns)
+        ]
+        summary = self.exec_sql_arrow(
+            f"SELECT {', '.join(aggregates)} FROM (\n{_strip_sql(sql)}\n) AS result"
+        )
+        values = [column[0].as_py() for column in summary.columns]
+        return dict(
+            head=head,
+            num_rows=values[0],
+            columns=[
+                dict(
+                    name=col,
+                    min=values[1 + 3 * i],
+                    max=values[2 + 3 * i],
+                    nulls=values[3 + 3 * i],
+                )
+                for i, col in enumerate(columns)
+            ],
+        )
+
+    def _fetch_limit(self, limit: int = None) -> int:
+        """Rows to fetch: `limit` capped by max_result_rows, or one row more than
+        max_result_rows without a limit so that larger results are detected"""
+        max_rows = self.limits["max_result_rows"]
+        return min(limit, max_rows) if limit else max_rows + 1
+
+    def _check_result_rows(self, table: pa.Table, limit: int = None) -> None:
+        max_rows = self.limits["max_result_rows"]
+        if not limit and table.num_rows > max_rows:
+            raise ValueError(
+                f"Query result exceeds the limit of {max_rows:,} rows. Aggregate or "
+                "filter the data in the query."
+            )
+
+    def _quote(self, name: str) -> str:
+        return _quote_ident(name)
+
 
 class Files(DataFetcher):
     """Run sql queries on files in a directory"""
 
-    def __init__(self, data_dir: str, persist_data: bool = True):
+    def __init__(
+        self,
+        data_dir: str,
+        persist_data: bool = True,
+        on_progress: Callable[[dict], None] = None,
+        **limits,
+    ):
+        """`limits` override the defaults in `QUERY_LIMITS`. `on_progress` is called
+        with the table, its number of rows and the number of files done after each
+        file has been loaded."""
         self.data_dir = data_dir if persist_data else tempfile.TemporaryDirectory()
         self.persist_data = persist_data
         self.tables = []
-        self.con = duckdb.connect(
+        self.sources = {}
+        self.search_terms = {}
+        self._cursors = {}
+        self._schema_cache = {}
+        self._connect(
             database=os.path.join(
                 self.data_dir if persist_data else self.data_dir.name, "files_db.duckdb"
             ),
             read_only=False,
+            limits=limits,
+        )
+
+        # Tables from an earlier ingestion are reused if their file is unchanged
+        manifest_fp = Path(data_dir) / MANIFEST_FILENAME
+        # Manifests of older versions are outdated, but their tables can be reused
+        manifest = (
+            _read_manifest(manifest_fp, any_version=True) if persist_data else None
+        ) or {}
+        prev_sources = manifest.get("tables", {})
+        prev_search_terms = manifest.get("search_terms", {})
+        # Statistics are computed differently by other versions
+        prev_column_stats = (
+            manifest.get("column_stats", {})
+            if manifest.get("version") == MANIFEST_VERSION
+            else {}
         )
+        self.column_stats = {}
+        existing = {row[0] for row in self.con.execute("SHOW TABLES").fetchall()}
 
         # Load tables from files_dir_path into duckdb
-        for p in Path(data_dir).iterdir():
-            if "files_db" in p.name:
-                continue
-            df, name = self._load_table(p), p.stem
+        paths = [
+            p
+            for p in sorted(Path(data_dir).iterdir())
+            if "files_db" not in p.name and "data_fetcher" not in p.name
+        ]
+        for i, p in enumerate(paths):
+            name = p.stem
+            source = prev_sources.get(name)
+            if not (name in existing and source and _source_unchanged(p, source)):
+                source = _source_info(p)
+                self._ingest_table(p, name)
+                prev_search_terms.pop(name, None)
+                prev_column_stats.pop(name, None)
+            self.sources[name] = source
+            self.search_terms[name] = prev_search_terms.get(name) or (
+                self._sample_search_terms(name)
+            )
+            self.column_stats[name] = prev_column_stats.get(name) or (
+                self._column_stats(name)
+            )
             self.tables += [name]
+            if on_progress is not None:
+                num_rows = self.column_stats[name]["num_rows"]
+                on_progress(
+                    dict(table=name, num_rows=num_rows, done=i + 1, total=len(paths))
+                )
 
-            if persist_data:
-                self.con.execute(f"CREATE TABLE {name} AS SELECT * FROM df")
+        for name in set(prev_sources) - set(self.tables):
+            self.con.execute(f"DROP TABLE IF EXISTS {_quote_ident(name)}")
+
+        self.schema_version = _schema_version(self.sources)
+        self.tables_info = self.get_tables_info()
+        self.schema_index = SchemaIndex(self.search_terms)
+
+    def _ingest_table(self, path: Path, name: str) -> None:
+        """Load file into duckdb. Formats duckdb can read are streamed straight into
+        the database by its native readers, other formats go through pandas."""
+        file_type = path.suffix[1:].lower()
+        if file_type not in DUCKDB_READERS:
+            df = self._load_table(path)
+            if self.persist_data:
+                self.con.execute(
+                    f"CREATE OR REPLACE TABLE {_quote_ident(name)} AS SELECT * FROM df"
+                )
             else:
                 self.con.register(name, df)
-        del df
-        gc.collect()
+            del df
+            gc.collect()
+            return
 
-        self.tables_info = self.get_tables_info()
+        relation = f"{DUCKDB_READERS[file_type]}({_quote_literal(str(path))})"
+        cols = self.con.execute(f"DESCRIBE SELECT * FROM {relation}").fetchall()
+        columns = ", ".join(
+            f"{_quote_ident(col[0])} AS {_quote_ident(col[0].strip().lower())}"
+            for col in cols
+        )
+        # Persisted data is copied into the database file, otherwise the file is
+        # registered as a lazy view that is read when queried.
+        table_type = "TABLE" if self.persist_data else "VIEW"
+        self.con.execute(
+            f"CREATE OR REPLACE {table_type} {_quote_ident(name)} "
+            f"AS SELECT {columns} FROM {relation}"
+        )
+
+    def _sample_search_terms(self, name: str) -> list[str]:
+        """Terms from the table name, column names and values of the first rows,
+        used to find the tables relevant to a question."""
+        cols = self.con.execute(f"DESCRIBE {_quote_ident(name)}").fetchall()
+        text_cols = [_quote_ident(col[0]) for col in cols if col[1] == "VARCHAR"]
+        values = []
+        if text_cols:
+            rows = self.con.execute(
+                f"SELECT {', '.join(text_cols)} FROM {_quote_ident(name)} LIMIT 50"
+            ).fetchall()
+            values = [value for row in rows for value in row if value]
+        return search_terms(name, [col[0] for col in cols], values)
+
+    def _column_stats(self, name: str) -> dict:
+        """Number of rows and for each column its number of distinct values,
+        fraction of nulls, min and max, and for text columns with few distinct
+        values the most frequent values. Computed once at ingestion with SUMMARIZE,
+        so describing the data to the llm needs no queries. Distinct values are
+        counted exactly in tables of at most EXACT_DISTINCT_MAX_ROWS rows, larger
+        tables keep the estimate of SUMMARIZE and are marked approximate."""
+        with span("column_stats", table=name) as attributes:
+            cursor = self.con.execute(f"SUMMARIZE {_quote_ident(name)}")
+            # The columns of SUMMARIZE differ between duckdb versions
+            names = [d[0] for d in cursor.description]
+            summary = [dict(zip(names, row)) for row in cursor.fetchall()]
+            (num_rows,) = self.con.execute(
+                f"SELECT count(*) FROM {_quote_ident(name)}"
+            ).fetchone()
+            exact = bool(summary) and num_rows <= EXACT_DISTINCT_MAX_ROWS
+            if exact:
+                counts = ", ".join(
+                    f"count(DISTINCT {_quote_ident(col['column_name'])})"
+                    for col in summary
+                )
+                distinct_counts = self.con.execute(
+                    f"SELECT {counts} FROM {_quote_ident(name)}"
+                ).fetchone()
+            columns = {}
+            for i, col in enumerate(summary):
+                stats = dict(
+                    null_fraction=float(col.get("null_percentage") or 0) / 100,
+                )
+                if exact:
+                    distinct = stats["distinct"] = distinct_counts[i]
+                else:
+                    distinct = min(col.get("approx_unique") or 0, num_rows)
+                    stats.update(distinct=distinct, approximate=True)
+                if col["column_type"] == "VARCHAR" and 0 < distinct <= MAX_CATEGORIES:
+                    rows = self.con.execute(
+                        f"""SELECT {_quote_ident(col['column_name'])}, count(*) AS n
+                        FROM {_quote_ident(name)}
+                        WHERE {_quote_ident(col['column_name'])} IS NOT NULL
+                        GROUP BY 1 ORDER BY n DESC, 1 LIMIT {TOP_VALUES}"""
+                    ).fetchall()
+                    stats["top_values"] = [row[0] for row in rows]
+                    if len(rows) < TOP_VALUES:
+                        stats["distinct"] = len(rows)
+                        stats.pop("approximate", None)
+                elif col["column_type"] != "VARCHAR":
+                    stats["min"], stats["max"] = col.get("min"), col.get("max")
+                columns[col["column_name"]] = stats
+            attributes["num_rows"] = num_rows
+        return dict(num_rows=num_rows, columns=columns)
 
     def _load_table(self, path: Path) -> pd.DataFrame:
         """Load table from file"""
@@ -57,41 +367,222 @@ class Files(DataFetcher):
         df = df.rename(columns={c: c.strip().lower() for c in df.columns})
         return df
 
-    def get_tables_info(self, tables: list[str] = None) -> str:
-        tables = tables if tables else self.tables
-        tables_info = ""
-        for table in tables:
-            query = f"""SELECT column_name, data_type
-                    FROM information_schema.columns
-                    WHERE table_name = '{table}';"""
-            cols = self.con.execute(query).fetchall()
-            tables_info += (
-                f"Table '{table}' has columns: "
-                + ", ".join([f"{col_name} ({col_type})" for col_name, col_type in cols])
-                + ".\n"
+    def get_schema(self, tables: list[str] = None) -> list[dict]:
+        """Tables with their columns, column types and row counts. The schema is
+        looked up with a single query and cached until the schema version changes."""
+        schema = self._schema_cache.get(self.schema_version)
+        if schema is None:
+            schema = self._query_schema()
+            self._schema_cache = {self.schema_version: schema}
+        schema = {table["table"]: table for table in schema}
+        return [schema[table] for table in (tables or self.tables) if table in schema]
+
+    def _query_schema(self) -> list[dict]:
+        # Row counts are only known for tables, not for views over files
+        query = """SELECT c.table_name,
+                    list(c.column_name ORDER BY c.ordinal_position),
+                    list(c.data_type ORDER BY c.ordinal_position),
+                    any_value(t.estimated_size)
+                FROM information_schema.columns c
+                LEFT JOIN duckdb_tables() t
+                    ON t.table_name = c.table_name AND t.schema_name = c.table_schema
+                GROUP BY c.table_name;"""
+        rows = {row[0]: row for row in self.cursor().execute(query).fetchall()}
+        return [
+            dict(
+                table=table,
+                columns=[
+                    dict(name=name, type=type)
+                    for name, type in zip(rows[table][1], rows[table][2])
+                ],
+                row_count=rows[table][3],
             )
-        return tables_info
+            for table in self.tables
+            if table in rows
+        ]
 
-    def exec_sql(self, sql: str) -> pd.DataFrame:
-        return self.con.execute(sql).df()
+    def exec_sql_arrow(
+        self, sql: str, use_cache: bool = True, limit: int = None
+    ) -> pa.Table:
+        """Run query. Results are cached for the current version of the data.
+
+        Queries return the first `limit` rows if a limit is given, are rejected if
+        duckdb estimates that the plan produces more than max_estimated_rows rows
+        and are cancelled after timeout seconds. Results of more than
+        max_result_rows rows raise instead of being cut short."""
+        sql = _limit_sql(sql, self._fetch_limit(limit))
+        with span("sql", fetcher="files") as attributes:
+            table = result_cache.get(sql, self.schema_version) if use_cache else None
+            attributes["cache"] = "hit" if table is not None else "miss"
+            if table is None:
+                cursor = self.cursor()
+                self._check_plan(cursor, sql)
+                table = self._execute(cursor, sql)
+                self._check_result_rows(table, limit)
+                if use_cache:
+                    result_cache.set(sql, self.schema_version, table)
+            attributes["num_rows"] = table.num_rows
+        return table
+
+    def explain(self, sql: str) -> float:
+        """Validate a query against the schema without running it. Returns the
+        number of rows duckdb estimates the plan to produce and raises if the query
+        is invalid or exceeds the max_estimated_rows limit."""
+        with span("explain", fetcher="files") as attributes:
+            estimate = self._plan_estimate(self.cursor(), _strip_sql(sql))
+            self._check_estimate(estimate)
+            attributes["estimated_rows"] = estimate
+        return estimate
+
+    def _check_plan(self, cursor: duckdb.DuckDBPyConnection, sql: str) -> None:
+        if not self.limits["max_estimated_rows"] or not is_query(sql):
+            return
+        self._check_estimate(self._plan_estimate(cursor, sql))
+
+    def _plan_estimate(self, cursor: duckdb.DuckDBPyConnection, sql: str) -> int:
+        try:
+            plan = cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}").fetchall()[0][-1]
+            estimate = max(_estimate_rows(node)[1] for node in json.loads(plan))
+        except (duckdb.ParserException, json.JSONDecodeError):
+            # Older duckdb versions only explain plans as text
+            plan = cursor.execute(f"EXPLAIN {sql}").fetchall()[0][-1]
+            estimates = re.findall(r"EC:\s*([\d,]+)|~([\d,]+) rows", plan)
+            estimate = max(
+                [int((ec or rows).replace(",", "")) for ec, rows in estimates] or [0]
+            )
+        return estimate
+
+    def _check_estimate(self, estimate: int) -> None:
+        max_rows = self.limits["max_estimated_rows"]
+        if max_rows and estimate > max_rows:
+            raise ValueError(
+                f"Query rejected: an estimated {estimate:,} rows exceeds the limit "
+                f"of {max_rows:,} rows. Check the query for missing join conditions."
+            )
+
+    def _execute(self, cursor: duckdb.DuckDBPyConnection, sql: str) -> pa.Table:
+        timeout = self.limits["timeout"]
+        if not timeout:
+            return _fetch_arrow(cursor.execute(sql))
+
+        interrupted = threading.Event()
+
+        def interrupt():
+            interrupted.set()
+            cursor.interrupt()
+
+        timer = threading.Timer(timeout, interrupt)
+        timer.start()
+        try:
+            return _fetch_arrow(cursor.execute(sql))
+        except (duckdb.Error, OSError, pa.ArrowException) as e:
+            # Interrupting the fetch of the result raises an OSError from arrow
+            if interrupted.is_set():
+                raise TimeoutError(f"Query cancelled after {timeout} seconds") from e
+            raise
+        finally:
+            timer.cancel()
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """Cursor for the calling thread. A duckdb connection must not be shared
+        between threads, but cursors on the same connection can."""
+        thread_id = threading.get_ident()
+        cursor = self._cursors.get(thread_id)
+        if cursor is None:
+            self._close_dead_cursors()
+            cursor = self._cursors[thread_id] = self.con.cursor()
+        return cursor
+
+    def _close_dead_cursors(self) -> None:
+        # Worker threads come and go, so cursors of finished threads are closed
+        alive = {thread.ident for thread in threading.enumerate()}
+        for thread_id in list(self._cursors):
+            if thread_id not in alive:
+                cursor = self._cursors.pop(thread_id, None)
+                if cursor is not None:
+                    cursor.close()
+
+    def _connect(self, database: str, read_only: bool, limits: dict) -> None:
+        unknown = set(limits) - set(QUERY_LIMITS)
+        if unknown:
+            raise ValueError(f"Unknown query limits: {', '.join(unknown)}")
+        self.limits = {**QUERY_LIMITS, **limits}
+        self.con = duckdb.connect(database, read_only=read_only)
+        if self.limits["memory_limit"]:
+            self.con.execute(f"SET memory_limit = '{self.limits['memory_limit']}'")
+        if self.limits["threads"]:
+            self.con.execute(f"SET threads = {int(self.limits['threads'])}")
+
+    def close(self) -> None:
+        for cursor in self._cursors.values():
+            cursor.close()
+        self._cursors = {}
+        if self.con is not None:
+            self.con.close()
+            self.con = None
 
     def save(self, fp: str):
-        self.con.close()
-        self.con = None
-        with open(fp, "wb") as f:
-            pickle.dump(self, f)
+        """Write a json manifest describing the ingested tables and close the
+        connection. The manifest is all `load` needs to reopen the database."""
+        if not self.persist_data:
+            raise ValueError("Only fetchers with persisted data can be saved.")
+        manifest = dict(
+            version=MANIFEST_VERSION,
+            created_at=datetime.utcnow().isoformat(),
+            data_dir=str(self.data_dir),
+            tables=self.sources,
+            schema_version=self.schema_version,
+            schema=self.get_schema(),
+            tables_info=self.tables_info,
+            search_terms=self.search_terms,
+            column_stats=self.column_stats,
+        )
+        self.close()
+        with open(fp, "w") as f:
+            json.dump(manifest, f, indent=2)
 
     @staticmethod
-    def load(fp: str):
-        with open(fp, "rb") as f:
-            data_fetcher = pickle.load(f)
-        duckdb_fp = str(data_fetcher.data_dir) + "/files_db.duckdb"
-        data_fetcher.con = duckdb.connect(duckdb_fp, read_only=False)
+    def load(fp: str, read_only: bool = False, **limits):
+        manifest = _read_manifest(fp)
+        if manifest is None:
+            raise ValueError(f"{fp} is not a valid data fetcher manifest.")
+        data_fetcher = Files.__new__(Files)
+        # The manifest lives in the data directory, which may have moved since
+        data_fetcher.data_dir = os.path.dirname(os.path.abspath(fp))
+        data_fetcher.persist_data = True
+        data_fetcher.tables = list(manifest["tables"])
+        data_fetcher.sources = manifest["tables"]
+        data_fetcher.tables_info = manifest["tables_info"]
+        data_fetcher.search_terms = manifest.get("search_terms", {})
+        data_fetcher.column_stats = manifest.get("column_stats", {})
+        data_fetcher.schema_index = SchemaIndex(data_fetcher.search_terms)
+        data_fetcher._cursors = {}
+        data_fetcher.schema_version = manifest["schema_version"]
+        data_fetcher._schema_cache = {manifest["schema_version"]: manifest["schema"]}
+        duckdb_fp = os.path.join(data_fetcher.data_dir, "files_db.duckdb")
+        data_fetcher._connect(duckdb_fp, read_only=read_only, limits=limits)
         return data_fetcher
 
+    @staticmethod
+    def is_outdated(fp: str) -> bool:
+        """Check if files have been added, removed or changed since the manifest
+        was written."""
+        manifest = _read_manifest(fp)
+        if manifest is None:
+            return True
+        files = {
+            p.stem: p
+            for p in Path(fp).resolve().parent.iterdir()
+            if not ("files_db" in p.name or "data_fetcher" in p.name)
+        }
+        sources = manifest["tables"]
+        return files.keys() != sources.keys() or not all(
+            _source_unchanged(p, sources[name]) for name, p in files.items()
+        )
+
     def __del__(self) -> None:
         try:
-            self.con.close()
+            self.close()
         except:
             pass
         if self.persist_data == False:
@@ -99,4 +590,395 @@ class Files(DataFetcher):
 
 
 class Database(DataFetcher):
-    ...
+    """Run sql queries on a database given by a SQLAlchemy url
+
+    Connections are taken from a pool, the schema is reflected once and kept in
+    memory until `refresh_schema` is called, and results are streamed from the
+    database in chunks of `chunk_size` rows. Only the timeout and max_result_rows
+    limits apply, since query plans are explained differently by each database.
+    Results are cached for at most `cache_ttl` seconds, because the data can change
+    without the schema changing.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        schema: str = None,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        chunk_size: int = 10_000,
+        cache_ttl: float = 300,
+        **limits,
+    ):
+        unknown = set(limits) - set(QUERY_LIMITS)
+        if unknown:
+            raise ValueError(f"Unknown query limits: {', '.join(unknown)}")
+        self.limits = {**QUERY_LIMITS, **limits}
+        self.url = sqlalchemy.engine.make_url(url)
+        self.schema = schema
+        self.chunk_size = chunk_size
+        self.cache_ttl = cache_ttl
+        connect_args = {}
+        if self.url.get_backend_name() == "sqlite":
+            connect_args["check_same_thread"] = False
+        self.engine = sqlalchemy.create_engine(
+            self.url,
+            poolclass=sqlalchemy.pool.QueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            connect_args=connect_args,
+        )
+        self.refresh_schema()
+
+    def refresh_schema(self) -> None:
+        """Reflect tables and columns from the database"""
+        inspector = sqlalchemy.inspect(self.engine)
+        self._schema = [
+            dict(
+                table=table,
+                columns=[
+                    dict(name=col["name"], type=str(col["type"]))
+                    for col in inspector.get_columns(table, schema=self.schema)
+                ],
+                # Counting rows is too slow on large databases
+                row_count=None,
+            )
+            for table in sorted(inspector.get_table_names(schema=self.schema))
+        ]
+        self.tables = [table["table"] for table in self._schema]
+        self.schema_version = _schema_version(
+            dict(url=self.url.render_as_string(hide_password=True), schema=self._schema)
+        )
+        self.search_terms = {
+            table["table"]: search_terms(
+                table["table"], [col["name"] for col in table["columns"]]
+            )
+            for table in self._schema
+        }
+        self.schema_index = SchemaIndex(self.search_terms)
+        self.tables_info = self.get_tables_info()
+
+    def get_schema(self, tables: list[str] = None) -> list[dict]:
+        schema = {table["table"]: table for table in self._schema}
+        return [schema[table] for table in (tables or self.tables) if table in schema]
+
+    @property
+    def data_version(self) -> str:
+        """The schema version and the current period of `cache_ttl` seconds, as
+        changes to the rows of the tables are not seen"""
+        if not self.cache_ttl:
+            return None
+        return f"{self.schema_version}-{int(time.time() // self.cache_ttl)}"
+
+    def exec_sql_arrow(
+        self, sql: str, use_cache: bool = True, limit: int = None
+    ) -> pa.Table:
+        """Run query and collect the streamed chunks. Queries return the first
+        `limit` rows if a limit is given, results of more than max_result_rows rows
+        raise instead of being cut short."""
+        fetch_limit = self._fetch_limit(limit)
+        fingerprint = self.data_version if use_cache else None
+        with span("sql", fetcher="database") as attributes:
+            table = None
+            if fingerprint is not None:
+                table = result_cache.get(_limit_sql(sql, fetch_limit), fingerprint)
+            attributes["cache"] = "hit" if table is not None else "miss"
+            if table is None:
+                table = pa.concat_tables(
+                    self.iter_sql_chunks(sql, limit=fetch_limit),
+                    promote_options="permissive",
+                )
+                self._check_result_rows(table, limit)
+                if fingerprint is not None:
+                    result_cache.set(_limit_sql(sql, fetch_limit), fingerprint, table)
+            attributes["num_rows"] = table.num_rows
+        return table
+
+    def iter_sql_chunks(self, sql: str, limit: int = None) -> Iterator[pa.Table]:
+        """Run query and yield the result in chunks of at most `chunk_size` rows. The
+        rows are fetched with a server side cursor where the database supports it,
+        so only one chunk is held in memory at a time. The query is cancelled after
+        timeout seconds if the database driver can cancel queries."""
+        if limit:
+            sql = _limit_sql(sql, limit)
+        with self.engine.connect() as con:
+            con = con.execution_options(
+                stream_results=True, max_row_buffer=self.chunk_size
+            )
+            # psycopg2 connections can be cancelled and sqlite3 interrupted
+            dbapi_con = con.connection.dbapi_connection
+            cancel = getattr(dbapi_con, "cancel", None) or getattr(
+                dbapi_con, "interrupt", None
+            )
+            timeout = self.limits["timeout"]
+            interrupted = threading.Event()
+
+            def interrupt():
+                interrupted.set()
+                cancel()
+
+            timer = threading.Timer(timeout, interrupt)
+            if timeout and cancel is not None:
+                timer.start()
+            try:
+                result = con.execute(sqlalchemy.text(sql))
+                columns = list(result.keys())
+                empty = True
+                for rows in result.partitions(self.chunk_size):
+                    empty = False
+                    yield pa.Table.from_pylist(
+                        [dict(zip(columns, row)) for row in rows]
+                    ).select(columns)
+                if empty:
+                    yield pa.table({col: pa.array([], pa.null()) for col in columns})
+            except sqlalchemy.exc.DBAPIError as e:
+                if interrupted.is_set():
+                    raise TimeoutError(
+                        f"Query cancelled after {timeout} seconds"
+                    ) from e
+                raise
+            finally:
+                timer.cancel()
+
+    def explain(self, sql: str) -> float:
+        """Validate a query by letting the database plan it. Plans of different
+        databases are not comparable, so the estimate is always math.inf."""
+        with span("explain", fetcher="database"):
+            with self.engine.connect() as con:
+                con.execute(sqlalchemy.text(f"EXPLAIN {_strip_sql(sql)}")).fetchall()
+        return math.inf
+
+    def _quote(self, name: str) -> str:
+        return self.engine.dialect.identifier_preparer.quote_identifier(name)
+
+    def close(self) -> None:
+        self.engine.dispose()
+
+
+class FetcherPool:
+    """Process wide pool of open fetchers keyed by data directory, or by url for
+    `Database` fetchers.
+
+    Fetchers are opened read-only, so every thread in the process can query the
+    same database through its own cursor. The least recently used fetcher is
+    removed when the pool is full and fetchers not used for `idle_timeout`
+    seconds are removed on the next lookup.
+
+    `get` leases the fetcher and `release` returns it. A removed fetcher is only
+    closed when its last lease is released, so it is never closed while in use.
+
+        with fetcher_pool.lease(data_dir) as data_fetcher:
+            data_fetcher.exec_sql(...)
+    """
+
+    def __init__(self, max_size: int = 16, idle_timeout: float = 600):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._fetchers = OrderedDict()  # data_dir -> (fetcher, last used)
+        self._leases = {}  # id(fetcher) -> number of leases
+        self._removed = {}  # id(fetcher) -> fetcher removed while leased
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, data_dir: str) -> Iterator[DataFetcher]:
+        fetcher = self.get(data_dir)
+        try:
+            yield fetcher
+        finally:
+            self.release(fetcher)
+
+    def get(self, data_dir: str) -> DataFetcher:
+        """Fetcher for `data_dir`, which must be passed to `release` when done"""
+        key = str(data_dir)
+        with self._lock:
+            self._close_idle()
+            if key in self._fetchers:
+                fetcher, _ = self._fetchers.pop(key)
+                self._fetchers[key] = (fetcher, time.monotonic())
+                self._acquire(fetcher)
+                return fetcher
+
+        # Open outside the lock so a slow load does not block other lookups
+        with span("fetcher_load", fetcher="database" if "://" in key else "files"):
+            fetcher = Database(key) if "://" in key else self._load_files(key)
+        with self._lock:
+            if key in self._fetchers:
+                fetcher.close()
+                fetcher, _ = self._fetchers.pop(key)
+            self._fetchers[key] = (fetcher, time.monotonic())
+            self._acquire(fetcher)
+            while len(self._fetchers) > self.max_size:
+                _, (evicted, _) = self._fetchers.popitem(last=False)
+                self._discard(evicted)
+        return fetcher
+
+    def release(self, fetcher: DataFetcher) -> None:
+        with self._lock:
+            self._leases[id(fetcher)] -= 1
+            if self._leases[id(fetcher)] == 0:
+                del self._leases[id(fetcher)]
+                removed = self._removed.pop(id(fetcher), None)
+                if removed is not None:
+                    removed.close()
+
+    def _acquire(self, fetcher: DataFetcher) -> None:
+        self._leases[id(fetcher)] = self._leases.get(id(fetcher), 0) + 1
+
+    def _discard(self, fetcher: DataFetcher) -> None:
+        """Close a fetcher removed from the pool, or when it is no longer leased"""
+        if self._leases.get(id(fetcher)):
+            self._removed[id(fetcher)] = fetcher
+        else:
+            fetcher.close()
+
+    def _load_files(self, data_dir: str) -> Files:
+        """Tables whose files changed since the manifest was written are
+        re-ingested. The file lock keeps other processes from opening the database
+        while it is written."""
+        manifest_fp = os.path.join(data_dir, MANIFEST_FILENAME)
+        with file_lock(os.path.join(data_dir, LOCK_FILENAME)):
+            if Files.is_outdated(manifest_fp):
+                try:
+                    Files(data_dir=data_dir, persist_data=True).save(manifest_fp)
+                except (duckdb.IOException, duckdb.ConnectionException) as e:
+                    # Another process, or a fetcher of this process that is still
+                    # leased, has the database open, so the tables are re-ingested
+                    # when it is no longer in use
+                    logger.warning(f"Could not re-ingest {data_dir}: {e}")
+            return Files.load(fp=manifest_fp, read_only=True)
+
+    def close(self, data_dir: str = None) -> None:
+        """Close the fetcher for `data_dir` or all fetchers if no dir is given"""
+        with self._lock:
+            keys = [str(data_dir)] if data_dir else list(self._fetchers)
+            for key in keys:
+                if key in self._fetchers:
+                    fetcher, _ = self._fetchers.pop(key)
+                    self._discard(fetcher)
+
+    def _close_idle(self) -> None:
+        now = time.monotonic()
+        for key, (fetcher, last_used) in list(self._fetchers.items()):
+            if now - last_used > self.idle_timeout:
+                del self._fetchers[key]
+                self._discard(fetcher)
+
+
+def _describe_column(column: dict, stats: dict) -> str:
+    description = [column["type"]]
+    if stats:
+        if stats.get("top_values"):
+            values = ", ".join(
+                _quote_literal(str(value)[:MAX_VALUE_CHARS])
+                for value in stats["top_values"]
+            )
+            more = "" if stats["distinct"] <= len(stats["top_values"]) else " and more"
+            description.append(f"values {values}{more}")
+        else:
+            if stats.get("min") is not None:
+                description.append(
+                    f"{str(stats['min'])[:MAX_VALUE_CHARS]} to "
+                    f"{str(stats['max'])[:MAX_VALUE_CHARS]}"
+                )
+            approximate = "~" if stats.get("approximate") else ""
+            description.append(f"{approximate}{stats['distinct']} distinct")
+        if stats["null_fraction"]:
+            description.append(f"{stats['null_fraction']:.0%} null")
+    return f"{column['name']} ({', '.join(description)})"
+
+
+def _read_manifest(fp, any_version: bool = False) -> dict:
+    """Manifest in the file or None if it is missing, invalid or of another
+    version than `MANIFEST_VERSION`, which makes it outdated"""
+    try:
+        with open(fp) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict):
+        return None
+    if any_version or manifest.get("version") == MANIFEST_VERSION:
+        return manifest
+    return None
+
+
+def _schema_version(sources: dict) -> str:
+    str_repr = json.dumps(sources, sort_keys=True)
+    return hashlib.sha256(str_repr.encode("utf8")).hexdigest()[:16]
+
+
+def _source_info(path: Path) -> dict:
+    stat = path.stat()
+    return dict(
+        file=path.name,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        checksum=_checksum(path),
+    )
+
+
+def _source_unchanged(path: Path, source: dict) -> bool:
+    """Compare file with the manifest entry. The checksum is only computed if
+    size or modification time differ."""
+    stat = path.stat()
+    if path.name != source["file"] or stat.st_size != source["size"]:
+        return False
+    return (
+        stat.st_mtime_ns == source["mtime_ns"] or _checksum(path) == source["checksum"]
+    )
+
+
+def _checksum(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _fetch_arrow(cursor: duckdb.DuckDBPyConnection) -> pa.Table:
+    # Newer duckdb versions return a record batch reader instead of a table
+    result = cursor.arrow()
+    return result.read_all() if isinstance(result, pa.RecordBatchReader) else result
+
+
+def _estimate_rows(node: dict) -> tuple[int, int]:
+    """Estimated rows produced by a node in a json query plan and the largest
+    estimate in its subtree. Cross products have no estimate in the plan, so they
+    are estimated as the product of their inputs."""
+    children = [_estimate_rows(child) for child in node.get("children", [])]
+    estimate = node.get("extra_info", {}).get("Estimated Cardinality")
+    if estimate is not None:
+        rows = int(estimate)
+    elif len(children) > 1:
+        rows = math.prod(child[0] for child in children)
+    else:
+        rows = children[0][0] if children else 0
+    return rows, max([rows] + [child[1] for child in children])
+
+
+def _limit_sql(sql: str, limit: int) -> str:
+    if not is_query(sql):
+        return sql
+    return f"SELECT * FROM (\n{_strip_sql(sql)}\n) AS limited LIMIT {int(limit)}"
+
+
+def _strip_sql(sql: str) -> str:
+    return sql.strip().rstrip(";")
+
+
+def _quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+fetcher_pool = FetcherPool(
+    max_size=int(config.get("FETCHER_POOL_SIZE", 16)),
+    idle_timeout=float(config.get("FETCHER_IDLE_TIMEOUT", 600)),
+)
+atexit.register(fetcher_pool.close)
@@ -1,56 +1,204 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
+from typing import Callable, Iterator
+import contextvars
+import math
+import pandas as pd
+from loguru import logger
+from .answer_cache import answer_cache
+from .config import config
+from .prompt_builder import (
+    PromptBuilder,
+    completion_tokens,
+    context_window,
+    count_tokens,
+)
 from .utils import openai_completion
+from .result_cache import result_store
+from .tracing import span
+
+MODEL = "text-davinci-003"
+# Most tokens of a completion. Fewer are requested when the prompt leaves less
+# room in the context window of the model.
+MAX_TOKENS = 2_000
+# Tokens kept free for the completion when shortening the plan prompt, the
+# context of the plot prompt and the description of the tables in the sql prompt
+PLAN_COMPLETION_TOKENS = 256
+PLOT_COMPLETION_TOKENS = 1_000
+SQL_COMPLETION_TOKENS = 500
+
+# Number of sql queries generated concurrently for each question to the database
+# and whether the first valid or the cheapest valid one is run
+SQL_CANDIDATES = int(config.get("SQL_CANDIDATES", 1))
+SQL_CANDIDATE_SELECT = config.get("SQL_CANDIDATE_SELECT", "first")
+# Candidates are generated at distinct temperatures spread evenly from 0, the
+# deterministic completion, to this maximum
+SQL_CANDIDATE_MAX_TEMPERATURE = 0.9
+
+_candidate_executor = ThreadPoolExecutor(
+    max_workers=int(config.get("SQL_CANDIDATE_WORKERS", 8)),
+    thread_name_prefix="sql-candidate",
+)
 
 
 def data_analyst(
     question: str,
     openai_api_key: str,
     data_fetcher,
+    llm: Callable = None,
+    sql_candidates: int = None,
+    use_answer_cache: bool = True,
 ) -> dict:
+    for event in data_analyst_stream(
+        question, openai_api_key, data_fetcher, llm, sql_candidates, use_answer_cache
+    ):
+        if event["type"] == "answer":
+            return event["response"]
+
+
+def data_analyst_stream(
+    question: str,
+    openai_api_key: str,
+    data_fetcher,
+    llm: Callable = None,
+    sql_candidates: int = None,
+    use_answer_cache: bool = True,
+) -> Iterator[dict]:
+    """Run the plan step by step and yield an event as soon as each step is done.
+    The event types are thought, sql, result, plot_code and finally answer, which
+    holds the same response as `data_analyst` returns. `llm` replaces the openai
+    completions, for instance to replay recorded completions in benchmarks. It is
+    called with the number of tokens to complete and, when more than one sql
+    candidate is generated, with a temperature.
+
+    When the answer cache is enabled, a question similar to one answered before
+    about the same data is answered with the stored response right away."""
+    data_version = data_fetcher.data_version
+    use_answer_cache = (
+        use_answer_cache and answer_cache.enabled and data_version is not None
+    )
+    if use_answer_cache:
+        response = cached_response(question, data_fetcher, data_version)
+        if response is not None:
+            yield dict(type="answer", response=response)
+            return
+
     action_data = {}
-    llm = partial(
+    sql_statement = None
+    llm = llm or partial(
         openai_completion,
         api_key=openai_api_key,
         temperature=0,
-        model="text-davinci-003",
-        max_tokens=2_000,
+        model=MODEL,
+        max_tokens=MAX_TOKENS,
     )
     plan = Plan(question=question, llm=llm)
-    for action in plan:
-        if action["tool"] == "FooBar DB":
-            obs = query_data(
-                question=action["input"], data_fetcher=data_fetcher, llm=llm
-            )
-            action_data["data"] = obs["df"]
-            plan.add_information(obs["df_obs"])
-        elif action["tool"] == "Plotter":
-            input_context = plan.prompt.replace(plan_prompt_intro, "").strip()
-            code = plot_data(
-                input_context=input_context,
-                question=action["input"],
-                llm=llm,
-            )
-            action_data["code"] = code
-            plan.add_information(code)
-        else:
-            pass
-    return dict(action=action, action_data=action_data)
+    with span("question", question=question) as attributes:
+        for action in plan:
+            yield dict(type="thought", **action)
+            with span("plan_step", tool=action["tool"]):
+                if action["tool"] == "FooBar DB":
+                    sql_statement = generate_sql(
+                        question=action["input"],
+                        data_fetcher=data_fetcher,
+                        llm=llm,
+                        n_candidates=sql_candidates or SQL_CANDIDATES,
+                    )
+                    yield dict(type="sql", sql=sql_statement)
+                    obs = run_sql(sql_statement, data_fetcher=data_fetcher)
+                    plan.add_information(obs["df_obs"])
+                    yield dict(type="result", preview=obs["df_obs"])
+                elif action["tool"] == "Plotter":
+                    if sql_statement is not None:
+                        action_data["data"] = store_result(sql_statement, data_fetcher)
+                    template = plot_prompt.format(
+                        input_summary="", question=action["input"]
+                    )
+                    input_context = plan.context(
+                        max_tokens=context_window(MODEL)
+                        - count_tokens(template, MODEL)
+                        - PLOT_COMPLETION_TOKENS
+                    )
+                    code = plot_data(
+                        input_context=input_context,
+                        question=action["input"],
+                        llm=llm,
+                    )
+                    action_data["code"] = code
+                    plan.add_information(code)
+                    yield dict(type="plot_code", code=code)
+                else:
+                    pass
+        if action["tool"] == "Plot" and "data" not in action_data and sql_statement:
+            action_data["data"] = store_result(sql_statement, data_fetcher)
+        attributes["answer"] = action["tool"]
+    if use_answer_cache and action["tool"] in ("Text", "Plot"):
+        answer_cache.set(
+            question,
+            data_version,
+            dict(
+                action=action,
+                data_sql=sql_statement if "data" in action_data else None,
+                code=action_data.get("code"),
+            ),
+        )
+    yield dict(type="answer", response=dict(action=action, action_data=action_data))
+
+
+def cached_response(question: str, data_fetcher, data_version: str) -> dict:
+    """Response to a similar question from the answer cache or None. The query
+    result of a plot is stored again, as the stored one may have been evicted."""
+    with span("answer_cache") as attributes:
+        cached = answer_cache.get(question, data_version)
+        attributes["cache"] = "hit" if cached is not None else "miss"
+        if cached is None:
+            return None
+        action_data = {}
+        if cached["data_sql"] is not None:
+            action_data["data"] = store_result(cached["data_sql"], data_fetcher)
+        if cached["code"] is not None:
+            action_data["code"] = cached["code"]
+        return dict(action=cached["action"], action_data=action_data)
 
 
 class Plan:
-    """Class for planning the actions to take to answer a questions"""
+    """Class for planning the actions to take to answer a questions. Observations
+    are shortened when the prompt would leave less than `PLAN_COMPLETION_TOKENS`
+    tokens for the next step."""
 
     def __init__(self, question: str, llm):
-        self.prompt = plan_prompt_intro + plan_prompt_thoughts.format(question=question)
+        self.question_prompt = plan_prompt_thoughts.format(question=question)
+        self.builder = PromptBuilder(
+            plan_prompt_intro + self.question_prompt,
+            max_tokens=context_window(MODEL) - PLAN_COMPLETION_TOKENS,
+            model=MODEL,
+        )
         self.llm = llm
 
+    @property
+    def prompt(self) -> str:
+        return self.builder.build()
+
+    def context(self, max_tokens: int) -> str:
+        """The question and the steps so far without the instructions in at most
+        `max_tokens` tokens"""
+        return self.builder.build(
+            head=self.question_prompt, max_tokens=max_tokens
+        ).strip()
+
     def next_step(self, stop: str = "\nObservation:") -> str:
-        action = self.llm(self.prompt, stop=stop, log_completion="plan")
-        self.prompt = self.prompt + action
+        prompt = self.prompt
+        action = self.llm(
+            prompt,
+            stop=stop,
+            log_completion="plan",
+            max_tokens=completion_tokens(prompt, MODEL, MAX_TOKENS),
+        )
+        self.builder.add_text(action)
         return action
 
     def add_information(self, observation: str) -> None:
-        self.prompt = self.prompt + "\nObservation: " + observation + "\nThought:"
+        self.builder.add_observation(observation)
 
     def __iter__(self, max_steps=5) -> str:
         for i in range(max_steps):
@@ -61,6 +209,7 @@ class Plan:
             action_out = dict(
                 tool=action.split(":")[-1].strip(),
                 input=action_input.split(":")[-1].strip(),
+                thought=thought.strip(),
             )
             if "\nFinal Answer:" in step or step == "":
                 break
@@ -70,16 +219,158 @@ class Plan:
 
 
 def query_data(question: str, data_fetcher, llm) -> dict:
-    prompt = data_prompt.format(tables_info=data_fetcher.tables_info, question=question)
-    sql_statement = llm(prompt, stop="\nSQLResult:", log_completion="data")
-    df = data_fetcher.exec_sql(sql_statement)
-    df_observation = "\n" + df.head().to_markdown()
-    return dict(df_obs=df_observation, df=df.to_json())
+    sql_statement = generate_sql(question, data_fetcher=data_fetcher, llm=llm)
+    obs = run_sql(sql_statement, data_fetcher=data_fetcher)
+    return dict(df_obs=obs["df_obs"], df=store_result(sql_statement, data_fetcher))
+
+
+def generate_sql(
+    question: str,
+    data_fetcher,
+    llm,
+    max_tables: int = 10,
+    n_candidates: int = 1,
+    select: str = SQL_CANDIDATE_SELECT,
+) -> str:
+    """Sql query answering the question. With more than one candidate, queries are
+    generated concurrently at different temperatures and validated with the query
+    planner, see `select_sql`."""
+    with span("generate_sql") as attributes:
+        # Only describe the tables relevant to the question to bound the prompt size
+        if len(data_fetcher.tables) > max_tables:
+            tables = data_fetcher.relevant_tables(question, k=max_tables)
+            tables_info = data_fetcher.get_tables_info(tables=tables)
+            attributes["tables"] = len(tables)
+        else:
+            tables = None
+            tables_info = data_fetcher.tables_info
+            attributes["tables"] = len(data_fetcher.tables)
+        prompt = data_prompt.format(tables_info=tables_info, question=question)
+        # The column statistics are left out if they do not fit
+        max_prompt_tokens = context_window(MODEL) - SQL_COMPLETION_TOKENS
+        if count_tokens(prompt, MODEL) > max_prompt_tokens:
+            tables_info = data_fetcher.get_tables_info(tables=tables, stats=False)
+            prompt = data_prompt.format(tables_info=tables_info, question=question)
+            attributes["stats"] = False
+        if n_candidates <= 1:
+            return llm(
+                prompt,
+                stop="\nSQLResult:",
+                log_completion="data",
+                max_tokens=completion_tokens(prompt, MODEL, MAX_TOKENS),
+            )
+        candidate = select_sql(prompt, data_fetcher, llm, n_candidates, select)
+        attributes["candidate"] = candidate["index"]
+        return candidate["sql"]
+
+
+def select_sql(
+    prompt: str, data_fetcher, llm, n_candidates: int, select: str = "first"
+) -> dict:
+    """Generate `n_candidates` sql queries concurrently and validate each with
+    `data_fetcher.explain` as soon as it is generated. Selects the first valid
+    query, cancelling the candidates that have not started, or with select
+    "cheapest" the valid query with the fewest estimated rows. If no query is
+    valid, the first candidate is returned, so running it reports the error."""
+    if select not in ("first", "cheapest"):
+        raise ValueError(f"Unknown sql candidate selection: {select}")
+
+    def generate(index):
+        temperature = round(
+            SQL_CANDIDATE_MAX_TEMPERATURE * index / max(n_candidates - 1, 1), 2
+        )
+        with span("sql_candidate", index=index, temperature=temperature) as attrs:
+            candidate = dict(index=index, sql=None, cost=None, error=None)
+            try:
+                candidate["sql"] = llm(
+                    prompt,
+                    stop="\nSQLResult:",
+                    log_completion="data",
+                    temperature=temperature,
+                    max_tokens=completion_tokens(prompt, MODEL, MAX_TOKENS),
+                )
+                candidate["cost"] = data_fetcher.explain(candidate["sql"])
+            except Exception as e:
+                candidate["error"] = e
+            attrs["valid"] = candidate["error"] is None
+            return candidate
+
+    # Each candidate runs in a copy of the context, so its spans are children of
+    # the running span
+    futures = [
+        _candidate_executor.submit(contextvars.copy_context().run, generate, i)
+        for i in range(n_candidates)
+    ]
+    candidates = []
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            candidates += [future.result() for future in done]
+            if select == "first" and any(c["error"] is None for c in candidates):
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+
+    valid = [c for c in candidates if c["error"] is None]
+    if valid:
+        return min(
+            valid,
+            key=lambda c: (
+                math.inf if select == "first" else c["cost"],
+                candidates.index(c),
+            ),
+        )
+    candidates.sort(key=lambda c: c["index"])
+    for candidate in candidates:
+        logger.warning(f"Sql candidate {candidate['index']}: {candidate['error']}")
+    generated = [c for c in candidates if c["sql"] is not None]
+    if not generated:
+        raise candidates[0]["error"]
+    return generated[0]
+
+
+def run_sql(sql_statement: str, data_fetcher) -> dict:
+    """Observe the first rows and a summary of the query result. The full result
+    is only fetched by `store_result` when it is needed for a plot."""
+    with span("run_sql") as attributes:
+        preview = data_fetcher.preview(sql_statement, n_rows=5)
+        attributes["num_rows"] = preview["num_rows"]
+    df_observation = "\n" + preview["head"].to_pandas().to_markdown()
+    if preview["num_rows"] > preview["head"].num_rows:
+        summary = pd.DataFrame(preview["columns"]).set_index("name")
+        df_observation += (
+            f"\n\nThe result has {preview['num_rows']} rows. Column summary:\n"
+            + summary.to_markdown()
+        )
+    max_rows = data_fetcher.limits["max_result_rows"]
+    if preview["num_rows"] > max_rows:
+        # The full result is fetched for plots, which fails above the limit
+        df_observation += (
+            f"\n\nThe result exceeds the limit of {max_rows:,} rows and cannot be "
+            "plotted. Aggregate or filter the data in the query."
+        )
+    return dict(df_obs=df_observation)
+
+
+def store_result(sql_statement: str, data_fetcher) -> dict:
+    # The result stays on the server, only a handle to it is returned
+    with span("store_result") as attributes:
+        table = data_fetcher.exec_sql_arrow(sql_statement)
+        attributes["num_rows"] = table.num_rows
+        return dict(result_id=result_store.put(table), num_rows=table.num_rows)
 
 
 def plot_data(input_context: str, question: str, llm) -> str:
-    prompt = plot_prompt.format(input_summary=input_context, question=question)
-    plot_code = llm(prompt=prompt, stop="\nfig.show()", log_completion="plot")
+    with span("plot_code"):
+        prompt = plot_prompt.format(input_summary=input_context, question=question)
+        plot_code = llm(
+            prompt=prompt,
+            stop="\nfig.show()",
+            log_completion="plot",
+            max_tokens=completion_tokens(prompt, MODEL, MAX_TOKENS),
+        )
     return plot_code
 
 
@@ -1,25 +1,57 @@
 from sqlmodel import Field, SQLModel, Session, select, create_engine
-from typing import Optional
+from typing import Optional, Iterator
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from loguru import logger
+import atexit
 import hashlib
+import os
+import queue
+import threading
+import time
+import zlib
 from ada.config import config
+from ada.locks import file_lock
+from sqlalchemy import Column, DateTime, Text, TypeDecorator, event, text, update
 from sqlalchemy.dialects.sqlite import insert
 import pandas as pd
 
 
+class CompressedText(TypeDecorator):
+    """Text stored zlib compressed. SQLite keeps the compressed bytes as a blob
+    whatever the declared column type, and uncompressed text stored before
+    compression was introduced is returned as is."""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else zlib.compress(value.encode("utf8"))
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return zlib.decompress(value).decode("utf8")
+
+
 class Completion(SQLModel, table=True):
     hash_id: Optional[str] = Field(primary_key=True, index=True)
-    prompt: str
+    prompt: str = Field(sa_column=Column(CompressedText, nullable=False))
     stop: Optional[str]
     model: str
     max_tokens: int
     temperature: float
-    completion: Optional[str]
+    completion: Optional[str] = Field(sa_column=Column(CompressedText))
+    created_at: Optional[datetime] = Field(sa_column=Column(DateTime))
+    last_hit_at: Optional[datetime] = Field(sa_column=Column(DateTime, index=True))
 
     def __init__(self, *args, **kwargs):
         if args:
             raise ValueError("Only kwargs are allowed")
 
         kwargs["hash_id"] = self.get_hash_id(**kwargs)
+        kwargs.setdefault("created_at", datetime.utcnow())
+        kwargs.setdefault("last_hit_at", kwargs["created_at"])
         super().__init__(**kwargs)
 
     @staticmethod
@@ -29,8 +61,118 @@ class Completion(SQLModel, table=True):
         return hash_id
 
 
+class Answer(SQLModel, table=True):
+    """Final response of the data analyst to a question about a dataset"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    fingerprint: str = Field(index=True)
+    question: str
+    normalized_question: str
+    response: str = Field(sa_column=Column(Text, nullable=False))  # json
+    created_at: datetime = Field(sa_column=Column(DateTime, index=True))
+    last_hit_at: Optional[datetime] = Field(sa_column=Column(DateTime))
+
+
+class LRUCache:
+    def __init__(self, max_size: int = 1_000, ttl: float = 3_600):
+        """
+        Thread safe in-memory cache evicting the least recently used entry when
+        full. Entries older than `ttl` seconds are treated as missing.
+
+        **Parameters**
+
+        * `max_size`: Maximum number of entries
+        * `ttl`: Time to live in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+
+class WriteBehindQueue:
+    def __init__(self, write_batch, batch_size: int = 100):
+        """
+        Queue whose items are written in batches by a background thread, so
+        writes are kept off the request path.
+
+        **Parameters**
+
+        * `write_batch`: Function called with a list of queued items
+        * `batch_size`: Maximum number of items written at once
+        """
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, item) -> None:
+        self._ensure_thread()
+        self._queue.put(item)
+
+    def flush(self) -> None:
+        """Block until all queued items have been written"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def _ensure_thread(self) -> None:
+        # The thread is (re)started lazily so the queue also works in processes
+        # forked after the module was imported.
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except Exception:
+                logger.exception(f"Failed to write {len(batch)} cached items")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
 class CRUDCompletion:
-    def __init__(self, model, engine):
+    def __init__(
+        self, model, engine, memory_cache: LRUCache = None, write_behind: bool = False
+    ):
         """
         CRUD object with default methods to Create, Read, Update, Delete (CRUD).
 
@@ -38,22 +180,149 @@ class CRUDCompletion:
 
         * `model`: A SQLModel class
         * `engine`: A sqlalchemy engine
+        * `memory_cache`: Optional in-memory cache checked before the database
+        * `write_behind`: Write new objects in batches from a background thread
         """
         self.model = model
         self.engine = engine
+        self.memory_cache = memory_cache
+        self.write_queue = WriteBehindQueue(self.create_many) if write_behind else None
+        # Hits are recorded in batches, as `last_hit_at` is only used for eviction
+        self.hit_queue = WriteBehindQueue(self.record_hits)
 
     def get(self, hash_id) -> Completion:
+        if self.memory_cache is not None:
+            completion = self.memory_cache.get(hash_id)
+            if completion is not None:
+                self.hit_queue.put(hash_id)
+                return completion
+
         with Session(self.engine) as session:
             stmt = select(Completion).where(Completion.hash_id == hash_id)
-            return session.exec(stmt).first()
+            completion = session.exec(stmt).first()
+        if completion is not None:
+            self.hit_queue.put(hash_id)
+            if self.memory_cache is not None:
+                self.memory_cache.set(hash_id, completion)
+        return completion
 
-    def get_all(self) -> list[Completion]:
-        with Session(self.engine) as session:
-            stmt = select(Completion)
-            result = session.exec(stmt).all()
-        return pd.DataFrame([r.dict() for r in result])
+    def iter_pages(self, page_size: int = 1_000) -> Iterator[pd.DataFrame]:
+        """Iterate over all completions one page at a time"""
+        last_hash_id = ""
+        while True:
+            with Session(self.engine) as session:
+                stmt = (
+                    select(Completion)
+                    .where(Completion.hash_id > last_hash_id)
+                    .order_by(Completion.hash_id)
+                    .limit(page_size)
+                )
+                result = session.exec(stmt).all()
+            if not result:
+                return
+            last_hash_id = result[-1].hash_id
+            yield pd.DataFrame([r.dict() for r in result])
+
+    def record_hits(self, hash_ids: list[str]) -> None:
+        with Session(self.engine) as session, session.begin():
+            stmt = (
+                update(self.model)
+                .where(self.model.hash_id.in_(set(hash_ids)))
+                .values(last_hit_at=datetime.utcnow())
+            )
+            session.exec(stmt)
+
+    def evict(
+        self,
+        max_rows: int = None,
+        max_bytes: int = None,
+        model_ttls: dict[str, timedelta] = None,
+    ) -> int:
+        """
+        Delete completions and return the number of deleted rows. Completions
+        are deleted least recently hit first.
+
+        **Parameters**
+
+        * `max_rows`: Maximum number of completions to keep
+        * `max_bytes`: Maximum stored size of prompts and completions
+        * `model_ttls`: Time to live since last hit for completions of a model
+        """
+        last_used = "coalesce(last_hit_at, created_at)"
+        statements = []
+        for model, ttl in (model_ttls or {}).items():
+            statements.append(
+                (
+                    f"DELETE FROM completion WHERE model = :model "
+                    f"AND {last_used} < :cutoff",
+                    dict(model=model, cutoff=_sqlite_datetime(datetime.utcnow() - ttl)),
+                )
+            )
+        if max_rows is not None:
+            statements.append(
+                (
+                    f"""DELETE FROM completion WHERE hash_id IN (
+                        SELECT hash_id FROM completion
+                        ORDER BY {last_used} DESC LIMIT -1 OFFSET :max_rows)""",
+                    dict(max_rows=max_rows),
+                )
+            )
+        if max_bytes is not None:
+            statements.append(
+                (
+                    f"""DELETE FROM completion WHERE hash_id IN (
+                        SELECT hash_id FROM (
+                            SELECT hash_id, SUM(
+                                length(prompt) + coalesce(length(completion), 0)
+                            ) OVER (
+                                ORDER BY {last_used} DESC, hash_id
+                                ROWS UNBOUNDED PRECEDING
+                            ) AS total_bytes
+                            FROM completion)
+                        WHERE total_bytes > :max_bytes)""",
+                    dict(max_bytes=max_bytes),
+                )
+            )
+
+        n_deleted = 0
+        with Session(self.engine) as session, session.begin():
+            for stmt, params in statements:
+                n_deleted += session.execute(text(stmt), params).rowcount
+        return n_deleted
+
+    def compress_all(self, batch_size: int = 500) -> int:
+        """Compress completions stored before compression was introduced"""
+        stmt = select(Completion).where(text("typeof(prompt) = 'text'"))
+        n_compressed = 0
+        while True:
+            with Session(self.engine) as session, session.begin():
+                result = session.exec(stmt.limit(batch_size)).all()
+                for r in result:
+                    session.exec(
+                        update(self.model)
+                        .where(self.model.hash_id == r.hash_id)
+                        .values(prompt=r.prompt, completion=r.completion)
+                    )
+            if not result:
+                return n_compressed
+            n_compressed += len(result)
+
+    def vacuum(self) -> None:
+        with self.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT"
+        ) as con:
+            con.execute(text("VACUUM"))
+            con.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
 
     def create(self, model_obj: Completion) -> None:
+        # The memory cache is updated right away, so the object can be read in
+        # this process before it has been written to the database.
+        if self.memory_cache is not None:
+            self.memory_cache.set(model_obj.hash_id, model_obj)
+        if self.write_queue is not None:
+            self.write_queue.put(model_obj)
+            return
+
         with Session(self.engine) as session, session.begin():
             stmt = (
                 insert(self.model)
@@ -62,6 +331,56 @@ class CRUDCompletion:
             )
             session.exec(stmt)
 
+    def create_many(self, model_objs: list[Completion]) -> None:
+        with Session(self.engine) as session, session.begin():
+            stmt = (
+                insert(self.model)
+                .values([model_obj.dict() for model_obj in model_objs])
+                .on_conflict_do_nothing()
+            )
+            session.exec(stmt)
+
+    def flush(self) -> None:
+        if self.write_queue is not None:
+            self.write_queue.flush()
+        self.hit_queue.flush()
+
+
+class CRUDAnswer:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def list_answers(
+        self, fingerprint: str, since: datetime, limit: int = 1_000
+    ) -> list[Answer]:
+        """Most recent answers about the dataset created after `since`"""
+        with Session(self.engine) as session:
+            stmt = (
+                select(Answer)
+                .where(Answer.fingerprint == fingerprint, Answer.created_at >= since)
+                .order_by(Answer.created_at.desc())
+                .limit(limit)
+            )
+            return session.exec(stmt).all()
+
+    def create(self, answer: Answer) -> None:
+        with Session(self.engine) as session, session.begin():
+            session.add(answer)
+
+    def record_hit(self, answer_id: int) -> None:
+        with Session(self.engine) as session, session.begin():
+            stmt = (
+                update(Answer)
+                .where(Answer.id == answer_id)
+                .values(last_hit_at=datetime.utcnow())
+            )
+            session.exec(stmt)
+
+    def delete_before(self, before: datetime) -> int:
+        with Session(self.engine) as session, session.begin():
+            stmt = text("DELETE FROM answer WHERE created_at < :before")
+            return session.execute(stmt, dict(before=_sqlite_datetime(before))).rowcount
+
 
 sqlite_fp = config["DATA_DIR"] / "databases" / "db.sqlite"
 sqlite_url = f"sqlite:///{str(sqlite_fp)}"
@@ -69,8 +388,59 @@ connect_args = {"check_same_thread": False}
 engine = create_engine(sqlite_url, echo=False, connect_args=connect_args)
 
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers and a writer work concurrently and busy_timeout makes
+    # connections wait for a lock instead of failing with "database is locked"
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def _sqlite_datetime(dt: datetime) -> str:
+    # Same format as sqlalchemy uses for DateTime columns in SQLite
+    return dt.isoformat(sep=" ", timespec="microseconds")
+
+
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    # Every worker process of the dashboard runs this when it starts
+    with file_lock(sqlite_fp.with_suffix(".lock")):
+        SQLModel.metadata.create_all(engine)
+        migrate_completion_table()
+
+
+def migrate_completion_table():
+    """Add the timestamp columns to completion tables created before eviction was
+    introduced. Existing rows count as created now."""
+    with engine.begin() as con:
+        columns = {row[1] for row in con.execute(text("PRAGMA table_info(completion)"))}
+        for column in ["created_at", "last_hit_at"]:
+            if column not in columns:
+                con.execute(
+                    text(f"ALTER TABLE completion ADD COLUMN {column} DATETIME")
+                )
+        con.execute(
+            text("UPDATE completion SET created_at = :now WHERE created_at IS NULL"),
+            dict(now=_sqlite_datetime(datetime.utcnow())),
+        )
+        con.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_completion_last_hit_at "
+                "ON completion (last_hit_at)"
+            )
+        )
 
 
-crud_completion = CRUDCompletion(Completion, engine)
+crud_completion = CRUDCompletion(
+    Completion,
+    engine,
+    memory_cache=LRUCache(
+        max_size=int(config.get("COMPLETION_CACHE_SIZE", 1_000)),
+        ttl=float(config.get("COMPLETION_CACHE_TTL", 3_600)),
+    ),
+    write_behind=True,
+)
+atexit.register(crud_completion.flush)
+crud_answer = CRUDAnswer(engine)
@@ -0,0 +1,132 @@
+import asyncio
+import random
+import threading
+import time
+import openai
+from ada.config import config
+from ada.prompt_builder import count_tokens
+from ada.tracing import annotate
+
+
+class TokenBucket:
+    """Rate limiter allowing `per_minute` units per minute with bursts of up to
+    `per_minute` units"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount: float = 1) -> None:
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class CompletionClient:
+    """Asynchronous client for the openai completion endpoint.
+
+    Requests are limited by requests and tokens per minute and by the number of
+    concurrent requests. Rate limit errors, server errors and timeouts are retried
+    with jittered exponential backoff. All requests run on one event loop in a
+    background thread, so the limits are shared by every thread in the process.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 3_000,
+        tokens_per_minute: float = 250_000,
+        max_concurrency: int = 16,
+        max_retries: int = 5,
+        backoff: float = 1,
+        max_backoff: float = 30,
+        api_base: str = None,
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.api_base = api_base
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def complete(self, **kwargs) -> str:
+        """Blocking completion. Takes the arguments of `openai.Completion.create`.
+        The token usage is added to the running span."""
+        text, usage = asyncio.run_coroutine_threadsafe(
+            self._complete(**kwargs), self._get_loop()
+        ).result()
+        annotate(**usage)
+        return text
+
+    async def acomplete(self, **kwargs) -> str:
+        """Completion that can be awaited from any event loop"""
+        future = asyncio.run_coroutine_threadsafe(
+            self._complete(**kwargs), self._get_loop()
+        )
+        text, usage = await asyncio.wrap_future(future)
+        annotate(**usage)
+        return text
+
+    async def _complete(self, **kwargs) -> tuple[str, dict]:
+        n_tokens = count_tokens(
+            kwargs.get("prompt", ""), kwargs.get("model")
+        ) + kwargs.get("max_tokens", 16)
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire()
+            await self.token_bucket.acquire(n_tokens)
+            try:
+                async with self.semaphore:
+                    response = await openai.Completion.acreate(
+                        api_base=self.api_base, **kwargs
+                    )
+                usage = response.get("usage", {})
+                return response["choices"][0]["text"], dict(
+                    prompt_tokens=usage.get("prompt_tokens"),
+                    completion_tokens=usage.get("completion_tokens"),
+                    attempts=attempt + 1,
+                )
+            except openai.error.OpenAIError as e:
+                if attempt == self.max_retries or not _is_retryable(e):
+                    raise
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="llm-client", daemon=True
+                ).start()
+        return self._loop
+
+
+def _is_retryable(error: openai.error.OpenAIError) -> bool:
+    retryable = (
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.TryAgain,
+    )
+    return isinstance(error, retryable) or (error.http_status or 0) >= 500
+
+
+completion_client = CompletionClient(
+    requests_per_minute=float(config.get("OPENAI_REQUESTS_PER_MINUTE", 3_000)),
+    tokens_per_minute=float(config.get("OPENAI_TOKENS_PER_MINUTE", 250_000)),
+    max_concurrency=int(config.get("OPENAI_MAX_CONCURRENCY", 16)),
+    api_base=config.get("OPENAI_API_BASE"),
+)
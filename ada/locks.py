@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # File locks are only available on unix
+    fcntl = None
+
+
+@contextmanager
+def file_lock(path: Path, shared: bool = False):
+    """Hold a lock on the file `path` while in the context, so work on files shared
+    by several processes (and threads) is done one at a time. The lock file is
+    created if it does not exist."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as fp:
+        if fcntl is not None:
+            fcntl.flock(fp, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp, fcntl.LOCK_UN)
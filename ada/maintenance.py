@@ -0,0 +1,60 @@
+"""Maintenance of the completion and answer caches.
+
+Example: evict completions of text-davinci-003 not hit for 30 days, keep at most
+1 GB and compact the database file
+
+    python -m ada.maintenance --ttl text-davinci-003=30 --max-bytes 1000000000
+"""
+
+from datetime import datetime, timedelta
+import argparse
+from ada import db_cache
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Evict and compact cached completions")
+    parser.add_argument("--max-rows", type=int, help="Number of completions to keep")
+    parser.add_argument("--max-bytes", type=int, help="Stored size to keep")
+    parser.add_argument(
+        "--ttl",
+        action="append",
+        default=[],
+        metavar="MODEL=DAYS",
+        help="Delete completions of MODEL not hit for DAYS days",
+    )
+    parser.add_argument(
+        "--answer-ttl",
+        type=float,
+        metavar="DAYS",
+        help="Delete cached answers older than DAYS days",
+    )
+    parser.add_argument(
+        "--no-vacuum", action="store_true", help="Do not vacuum the database file"
+    )
+    args = parser.parse_args(args)
+
+    model_ttls = {}
+    for ttl in args.ttl:
+        model, days = ttl.rsplit("=", 1)
+        model_ttls[model] = timedelta(days=float(days))
+
+    db_cache.create_db_and_tables()
+    n_compressed = db_cache.crud_completion.compress_all()
+    n_deleted = db_cache.crud_completion.evict(
+        max_rows=args.max_rows, max_bytes=args.max_bytes, model_ttls=model_ttls
+    )
+    n_answers = 0
+    if args.answer_ttl is not None:
+        n_answers = db_cache.crud_answer.delete_before(
+            datetime.utcnow() - timedelta(days=args.answer_ttl)
+        )
+    if not args.no_vacuum:
+        db_cache.crud_completion.vacuum()
+    print(
+        f"Compressed {n_compressed} and deleted {n_deleted} completions "
+        f"and {n_answers} answers"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+from functools import lru_cache
+from loguru import logger
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:  # Tokens are estimated from the text instead
+    tiktoken = None
+
+# Tokens shared by the prompt and the completion
+CONTEXT_WINDOWS = {
+    "text-davinci-003": 4_097,
+    "text-davinci-002": 4_097,
+    "gpt-3.5-turbo-instruct": 4_096,
+}
+DEFAULT_CONTEXT_WINDOW = 4_097
+# Text replacing the part of an observation that did not fit in the prompt
+TRUNCATED = "\n... (truncated)"
+OMITTED = "(omitted)"
+# Pieces the text is split into before it is tokenized, as in the tokenizers of
+# the gpt models. A token never spans two pieces.
+PIECES = re.compile(r" ?[A-Za-z]+| ?[0-9]+| ?[^\sA-Za-z0-9]+|\s+")
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Number of tokens in the text with the tokenizer of the model, or a
+    conservative estimate if tiktoken or the tokenizer is not available"""
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate of the number of tokens, which errs on the high side. Words are
+    counted as a token per three letters, numbers as a token per two digits and
+    punctuation and other characters as a token per byte, but the estimate is at
+    least a token per two bytes, as markdown tables and query results often take
+    a token per two characters or less."""
+    tokens = 0
+    for piece in PIECES.findall(text):
+        word = piece.lstrip(" ")
+        if word.isascii() and word.isalpha():
+            tokens += math.ceil(len(word) / 3)
+        elif word.isascii() and word.isdigit():
+            tokens += math.ceil(len(word) / 2)
+        elif word:
+            tokens += len(word.encode("utf8"))
+        else:
+            tokens += 1  # whitespace
+    return max(tokens, math.ceil(len(text.encode("utf8")) / 2))
+
+
+def context_window(model: str) -> int:
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+def completion_tokens(prompt: str, model: str, max_tokens: int) -> int:
+    """Tokens left for the completion of the prompt, at most `max_tokens`"""
+    left = context_window(model) - count_tokens(prompt, model)
+    if left <= 0:
+        raise ValueError(
+            f"The prompt of {count_tokens(prompt, model)} tokens does not fit in the "
+            f"context window of {model}"
+        )
+    return min(max_tokens, left)
+
+
+def truncate(text: str, max_tokens: int, model: str) -> str:
+    """Beginning of the text with at most `max_tokens` tokens. Cuts at a line
+    break where possible, so table rows are not cut in half."""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(TRUNCATED, model)
+    if budget <= 0:
+        return OMITTED
+    # Binary search for the longest prefix that fits
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid], model) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    head = text[:low]
+    if "\n" in head.strip("\n"):
+        head = head[: head.rstrip("\n").rfind("\n")]
+    return head + TRUNCATED
+
+
+class PromptBuilder:
+    """Prompt of a fixed head followed by steps of the model's own text, which is
+    kept as is, and observations, which are shortened to keep the prompt within
+    `max_tokens`. Older observations are shortened first: each is truncated to
+    `max_old_observation_tokens` and then omitted, oldest first, until the prompt
+    fits. Only then is the latest observation truncated.
+
+    A prompt that fits is returned unchanged, so completions cached for it are
+    still hit."""
+
+    def __init__(
+        self,
+        head: str,
+        max_tokens: int,
+        model: str,
+        max_old_observation_tokens: int = 200,
+        observation_template: str = "\nObservation: {observation}\nThought:",
+    ):
+        self.head = head
+        self.max_tokens = max_tokens
+        self.model = model
+        self.max_old_observation_tokens = max_old_observation_tokens
+        self.observation_template = observation_template
+        self.parts = []  # [(kind, text)] with kind "text" or "observation"
+
+    def add_text(self, text: str) -> None:
+        self.parts.append(("text", text))
+
+    def add_observation(self, observation: str) -> None:
+        self.parts.append(("observation", observation))
+
+    def build(self, head: str = None, max_tokens: int = None) -> str:
+        """Prompt fitting in `max_tokens`. `head` and `max_tokens` replace those of
+        the builder, for instance to use the steps as context in another prompt."""
+        head = self.head if head is None else head
+        max_tokens = max_tokens or self.max_tokens
+        parts = [list(part) for part in self.parts]
+        observations = [i for i, (kind, _) in enumerate(parts) if kind == "observation"]
+
+        def prompt():
+            return head + "".join(
+                (
+                    self.observation_template.format(observation=text)
+                    if kind == "observation"
+                    else text
+                )
+                for kind, text in parts
+            )
+
+        if count_tokens(prompt(), self.model) <= max_tokens:
+            return prompt()
+        for i in observations[:-1]:
+            parts[i][1] = truncate(
+                parts[i][1], self.max_old_observation_tokens, self.model
+            )
+        for i in observations[:-1]:
+            if count_tokens(prompt(), self.model) <= max_tokens:
+                return prompt()
+            parts[i][1] = OMITTED
+        if observations:
+            i = observations[-1]
+            parts[i][1] = ""
+            left = max_tokens - count_tokens(prompt(), self.model)
+            parts[i][1] = truncate(self.parts[i][1], left, self.model)
+        return prompt()
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:  # Unknown model or the encoding could not be downloaded
+        logger.warning(f"Estimating tokens, no tokenizer for {model}: {e}")
+        return None
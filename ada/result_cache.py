@@ -0,0 +1,158 @@
+from pathlib import Path
+from loguru import logger
+import pyarrow as pa
+import pyarrow.parquet as pq
+import hashlib
+import os
+import re
+import threading
+import uuid
+from ada.config import config
+
+# Queries whose result can change without the data changing are not cached
+NON_DETERMINISTIC = re.compile(r"\b(random|uuid|gen_random_uuid|now|current_\w+)\b")
+# Whitespace, comments and opening parentheses a query can start with
+LEADING_NOISE = re.compile(r"(?:\s|--[^\n]*|/\*.*?\*/|\()*", re.DOTALL)
+
+
+class ResultCache:
+    """Query results stored as parquet files on disk, keyed by the normalized sql
+    and a fingerprint of the data queried. The least recently used results are
+    deleted when the files take up more than `max_bytes`."""
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 1_000_000_000):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sql: str, fingerprint: str) -> pa.Table:
+        fp = self._path(sql, fingerprint)
+        try:
+            table = pq.read_table(fp)
+        except (FileNotFoundError, pa.ArrowException):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(fp)  # Modification time is used as last used time for eviction
+        return table
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses)
+
+    def set(self, sql: str, fingerprint: str, table: pa.Table) -> None:
+        if not is_cacheable(sql):
+            return
+        fp = self._path(sql, fingerprint)
+        tmp_fp = fp.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            pq.write_table(table, tmp_fp)
+            os.replace(tmp_fp, fp)
+        except (OSError, pa.ArrowException) as e:
+            logger.warning(f"Could not cache query result: {e}")
+            tmp_fp.unlink(missing_ok=True)
+            return
+        with self._lock:
+            evict_lru_files(self.cache_dir, "*.parquet", self.max_bytes)
+
+    def _path(self, sql: str, fingerprint: str) -> Path:
+        str_repr = f"{normalize_sql(sql)}{fingerprint}"
+        hash_id = hashlib.sha256(str_repr.encode("utf8")).hexdigest()
+        return self.cache_dir / f"{hash_id}.parquet"
+
+
+class ResultStore:
+    """Query results kept on the server as arrow files and referenced by an id, so
+    only the id has to be sent to the browser. The id is a hash of the result, so
+    equal results share a file and an id. Files are memory mapped when read and the
+    least recently used are deleted when they take up more than `max_bytes`."""
+
+    def __init__(self, store_dir: Path, max_bytes: int = 5_000_000_000):
+        self.store_dir = Path(store_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def put(self, table: pa.Table) -> str:
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        buffer = sink.getvalue()
+        result_id = hashlib.sha256(buffer).hexdigest()
+        fp = self.store_dir / f"{result_id}.arrow"
+        try:
+            os.utime(fp)
+            return result_id
+        except FileNotFoundError:
+            pass
+        tmp_fp = fp.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        with pa.OSFile(str(tmp_fp), "wb") as f:
+            f.write(buffer)
+        os.replace(tmp_fp, fp)
+        with self._lock:
+            evict_lru_files(self.store_dir, "*.arrow", self.max_bytes)
+        return result_id
+
+    def get(self, result_id: str, max_rows: int = None) -> pa.Table:
+        """Get result or None if it has been deleted. Results with more than
+        `max_rows` rows are downsampled to evenly spaced rows."""
+        fp = self.store_dir / f"{result_id}.arrow"
+        try:
+            table = pa.ipc.open_file(pa.memory_map(str(fp))).read_all()
+        except (FileNotFoundError, pa.ArrowException):
+            return None
+        os.utime(fp)
+        if max_rows is not None and table.num_rows > max_rows:
+            step = table.num_rows / max_rows
+            table = table.take(pa.array([int(i * step) for i in range(max_rows)]))
+        return table
+
+
+def evict_lru_files(directory: Path, pattern: str, max_bytes: int) -> None:
+    """Delete the files with the oldest modification time until the files matching
+    `pattern` take up at most `max_bytes`"""
+    files = []
+    for fp in directory.glob(pattern):
+        try:
+            stat = fp.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, fp))
+    total_bytes = sum(size for _, size, _ in files)
+    for _, size, fp in sorted(files):
+        if total_bytes <= max_bytes:
+            break
+        fp.unlink(missing_ok=True)
+        total_bytes -= size
+
+
+def normalize_sql(sql: str) -> str:
+    """Remove surrounding whitespace, trailing semicolons and repeated whitespace
+    outside of quoted strings and identifiers"""
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", sql.strip().rstrip(";"))
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts)
+    ).strip()
+
+
+def is_query(sql: str) -> bool:
+    """Whether the statement is a query, which may start with comments and
+    parentheses"""
+    start = LEADING_NOISE.match(sql).end()
+    return sql[start:].lower().startswith(("select", "with"))
+
+
+def is_cacheable(sql: str) -> bool:
+    return is_query(sql) and not NON_DETERMINISTIC.search(normalize_sql(sql).lower())
+
+
+result_cache = ResultCache(
+    cache_dir=config["DATA_DIR"] / "cache" / "results",
+    max_bytes=int(config.get("RESULT_CACHE_MAX_BYTES", 1_000_000_000)),
+)
+result_store = ResultStore(
+    store_dir=config["DATA_DIR"] / "cache" / "result_store",
+    max_bytes=int(config.get("RESULT_STORE_MAX_BYTES", 5_000_000_000)),
+)
@@ -0,0 +1,63 @@
+from collections import Counter
+import math
+import re
+
+
+class SchemaIndex:
+    """BM25 index for ranking tables by relevance to a question. Each table is
+    described by the terms in its name, its column names and sampled values."""
+
+    def __init__(
+        self, documents: dict[str, list[str]], k1: float = 1.5, b: float = 0.75
+    ):
+        self.tables = list(documents)
+        self.k1, self.b = k1, b
+        self.term_freqs = [Counter(terms) for terms in documents.values()]
+        self.doc_lens = [len(terms) for terms in documents.values()]
+        self.avg_len = sum(self.doc_lens) / len(self.doc_lens) if self.doc_lens else 0
+        doc_freqs = Counter(term for term_freq in self.term_freqs for term in term_freq)
+        n = len(self.tables)
+        self.idf = {
+            term: math.log(1 + (n - freq + 0.5) / (freq + 0.5))
+            for term, freq in doc_freqs.items()
+        }
+
+    def rank(self, question: str, k: int) -> list[str]:
+        """Return the k most relevant tables. Ties keep the original table order,
+        so a question without matching terms returns the first k tables."""
+        terms = [term for term in tokenize(question) if term in self.idf]
+        scores = []
+        for i, term_freq in enumerate(self.term_freqs):
+            norm = self.k1 * (
+                1 - self.b + self.b * self.doc_lens[i] / (self.avg_len or 1)
+            )
+            score = sum(
+                self.idf[term]
+                * term_freq[term]
+                * (self.k1 + 1)
+                / (term_freq[term] + norm)
+                for term in terms
+                if term in term_freq
+            )
+            scores.append((-score, i))
+        return [self.tables[i] for _, i in sorted(scores)[:k]]
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into lower case terms. Camel case and snake case identifiers are
+    split into words and plural s is removed."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text).lower()
+    return [
+        term[:-1] if len(term) > 3 and term.endswith("s") else term
+        for term in re.findall(r"[a-z0-9]+", text)
+    ]
+
+
+def search_terms(
+    table: str, columns: list[str], sampled_values: list[str] = None
+) -> list[str]:
+    """Terms describing a table. Names are repeated to weigh them above values."""
+    name_terms = tokenize(table) * 3 + tokenize(" ".join(columns)) * 2
+    sampled_values = sampled_values or []
+    value_terms = sorted(set(tokenize(" ".join(v[:50] for v in sampled_values))))
+    return name_terms + value_terms
@@ -0,0 +1,263 @@
+"""Spans with durations and attributes for the steps of answering a question
+
+    with span("sql", sql=sql) as attributes:
+        table = ...
+        attributes["num_rows"] = table.num_rows
+
+Finished spans are appended as json lines to a file per process named after
+`TRACE_FILE` and the process id (traces.<pid>.jsonl) and aggregated into
+metrics, which the dashboard serves in the Prometheus text format at /metrics.
+The attributes `cache`, `num_rows`, `prompt_tokens` and `completion_tokens` are
+also counted in the metrics.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from loguru import logger
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from ada.config import config
+
+# Upper bounds of the buckets of the duration histograms in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Metrics:
+    """Counters and histograms of the spans finished in this process. The metrics
+    of every process are written to `metrics_dir` within `dump_interval` seconds
+    of a change and summed when exported, so all worker processes are included no
+    matter which one serves /metrics."""
+
+    def __init__(self, metrics_dir: Path, dump_interval: float = 1):
+        self.metrics_dir = Path(metrics_dir)
+        self.dump_interval = dump_interval
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._dump_scheduled = False
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key, [[0] * len(DURATION_BUCKETS), 0.0, 0]
+            )
+            for i, bucket in enumerate(DURATION_BUCKETS):
+                if value <= bucket:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(
+                counters=[
+                    [name, dict(labels), value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                histograms=[
+                    [name, dict(labels), list(histogram[0]), *histogram[1:]]
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            )
+
+    def dump(self) -> None:
+        fp = self.metrics_dir / f"{os.getpid()}.json"
+        tmp_fp = fp.with_suffix(".tmp")
+        try:
+            self.metrics_dir.mkdir(parents=True, exist_ok=True)
+            tmp_fp.write_text(json.dumps(self.snapshot()))
+            os.replace(tmp_fp, fp)
+        except OSError as e:
+            logger.warning(f"Could not write metrics: {e}")
+
+    def schedule_dump(self) -> None:
+        with self._lock:
+            if self._dump_scheduled:
+                return
+            self._dump_scheduled = True
+        timer = threading.Timer(self.dump_interval, self._scheduled_dump)
+        timer.daemon = True
+        timer.start()
+
+    def _scheduled_dump(self) -> None:
+        with self._lock:
+            self._dump_scheduled = False
+        self.dump()
+
+    def clear(self) -> None:
+        """Delete the metrics written by earlier processes"""
+        for fp in self.metrics_dir.glob("*.json"):
+            fp.unlink(missing_ok=True)
+
+    def to_prometheus(self) -> str:
+        """Metrics of all processes in the Prometheus text format"""
+        self.dump()
+        counters = defaultdict(float)
+        histograms = {}
+        for fp in self.metrics_dir.glob("*.json"):
+            try:
+                snapshot = json.loads(fp.read_text())
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in snapshot["counters"]:
+                counters[(name, tuple(sorted(labels.items())))] += value
+            for name, labels, buckets, total, count in snapshot["histograms"]:
+                key = (name, tuple(sorted(labels.items())))
+                merged = histograms.setdefault(
+                    key, [[0] * len(DURATION_BUCKETS), 0.0, 0]
+                )
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (key_name, labels), (buckets, total, count) in sorted(
+                histograms.items()
+            ):
+                if key_name != name:
+                    continue
+                for bucket, n in zip(DURATION_BUCKETS, buckets):
+                    bucket_labels = labels + (("le", f"{bucket:g}"),)
+                    lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {n}")
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{_format_labels(inf_labels)} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """Record spans as json lines and metrics. A span started while another span
+    is running in the same context becomes its child and shares its trace id."""
+
+    def __init__(
+        self, metrics: Metrics, trace_file: Path = None, max_bytes: int = 100_000_000
+    ):
+        self.metrics = metrics
+        self.trace_file = Path(trace_file) if trace_file else None
+        self.max_bytes = max_bytes
+        self._file = None
+        self._pid = None
+        self._path = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the code in the context. Yields the attributes of the span, which
+        can be added to while it runs."""
+        parent = _current_span.get()
+        span = dict(
+            name=name,
+            trace_id=parent["trace_id"] if parent else uuid.uuid4().hex[:16],
+            span_id=uuid.uuid4().hex[:16],
+            parent_id=parent["span_id"] if parent else None,
+            start=time.time(),
+            attributes=attributes,
+        )
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span["attributes"]
+        except Exception as e:
+            span["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span["duration"] = time.perf_counter() - start
+            try:
+                _current_span.reset(token)
+            except ValueError:
+                # A generator holding the span was closed from another context
+                pass
+            self._finish(span)
+
+    def annotate(self, **attributes) -> None:
+        """Add attributes to the running span, if there is one"""
+        span = _current_span.get()
+        if span is not None:
+            span["attributes"].update(attributes)
+
+    def _finish(self, span: dict) -> None:
+        name, attributes = span["name"], span["attributes"]
+        self.metrics.observe("ada_span_duration_seconds", span["duration"], span=name)
+        if "error" in span:
+            self.metrics.inc("ada_span_errors_total", span=name)
+        if "cache" in attributes:
+            self.metrics.inc(
+                "ada_cache_requests_total", span=name, outcome=attributes["cache"]
+            )
+        if attributes.get("num_rows") is not None:
+            self.metrics.inc("ada_rows_total", attributes["num_rows"], span=name)
+        for kind in ["prompt", "completion"]:
+            if attributes.get(f"{kind}_tokens") is not None:
+                self.metrics.inc(
+                    "ada_llm_tokens_total", attributes[f"{kind}_tokens"], type=kind
+                )
+        self.metrics.schedule_dump()
+        if self.trace_file is not None:
+            self._write(json.dumps(span, default=str))
+
+    def _write(self, line: str) -> None:
+        """Append to the trace file of this process. Every worker process writes
+        its own file, so a file is only ever rotated by the process writing it."""
+        with self._lock:
+            try:
+                if self._file is not None and self._pid != os.getpid():
+                    # Forked after the file was opened
+                    self._file = None
+                if self._file is None:
+                    self._pid = os.getpid()
+                    self._path = self.trace_file.with_name(
+                        f"{self.trace_file.stem}.{self._pid}{self.trace_file.suffix}"
+                    )
+                    self._path.parent.mkdir(parents=True, exist_ok=True)
+                    self._file = open(self._path, "a", buffering=1)
+                self._file.write(line + "\n")
+                if self._file.tell() > self.max_bytes:
+                    # Keep the previous file, so at most twice max_bytes is used
+                    # per process
+                    self._file.close()
+                    self._file = None
+                    os.replace(self._path, f"{self._path}.1")
+            except OSError as e:
+                logger.warning(f"Could not write trace: {e}")
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+trace_file = config.get("TRACE_FILE", config["DATA_DIR"] / "logs" / "traces.jsonl")
+tracer = Tracer(
+    metrics=Metrics(config["DATA_DIR"] / "metrics"),
+    trace_file=trace_file or None,
+    max_bytes=int(config.get("TRACE_FILE_MAX_BYTES", 100_000_000)),
+)
+span = tracer.span
+annotate = tracer.annotate
+atexit.register(tracer.metrics.dump)
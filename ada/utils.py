@@ -1,8 +1,8 @@
-import openai
 from loguru import logger
 from . import db_cache
 from ada.config import config
-from time import sleep
+from ada.llm_client import completion_client
+from ada.tracing import span
 
 
 # openai.api_key = config["OPENAI_API_KEY"]
@@ -23,31 +23,38 @@ def openai_completion(
     api_key=None,
     log_completion="",
 ):
-    completion = db_cache.Completion(
-        prompt=prompt,
-        stop=stop,
-        model=model,
-        temperature=temperature,
-        max_tokens=max_tokens,
-        api_key=api_key,
-    )
-    completion_stored = db_cache.crud_completion.get(completion.hash_id)
-    if completion_stored:
-        completion = completion_stored.copy()
-    else:
-        sleep(1)  # Sleep for one second to avoid rate limiting
-        response = openai.Completion.create(
+    with span("llm", step=log_completion, model=model) as attributes:
+        hash_id = db_cache.Completion.get_hash_id(
             prompt=prompt,
+            stop=stop,
             model=model,
             temperature=temperature,
-            stop=stop,
             max_tokens=max_tokens,
-            api_key=api_key,
         )
-        text = response["choices"][0].text
-        completion.completion = text
-        db_cache.crud_completion.create(completion)
+        completion_stored = db_cache.crud_completion.get(hash_id)
+        if completion_stored:
+            attributes["cache"] = "hit"
+            text = completion_stored.completion
+        else:
+            attributes["cache"] = "miss"
+            text = completion_client.complete(
+                prompt=prompt,
+                model=model,
+                temperature=temperature,
+                stop=stop,
+                max_tokens=max_tokens,
+                api_key=api_key,
+            )
+            completion = db_cache.Completion(
+                prompt=prompt,
+                stop=stop,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                completion=text,
+            )
+            db_cache.crud_completion.create(completion)
 
     if log_completion:
-        logger.log(log_completion, completion.completion)
-    return completion.completion
+        logger.log(log_completion, text)
+    return text
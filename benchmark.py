@@ -0,0 +1,304 @@
+"""Benchmark ingestion and question answering on scaled copies of the imdb dataset.
+
+Completions are replayed from the completion cache, so no openai api key is
+needed, but the questions must have been answered once with a key (for instance
+by running example.py). Every scale runs in a fresh process, so the peak memory
+is measured per scale.
+
+Example: run on 1, 10 and 100 times the rows, save the results and compare them
+with an earlier run
+
+    python benchmark.py --scales 1 10 100 --compare baseline.json
+"""
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import time
+import duckdb
+from ada import data, db_cache, result_cache
+from ada.config import config
+from ada.data_analyst import data_analyst_stream
+from dashboard.plots import plot_runner
+
+try:
+    import resource
+except ImportError:  # Peak memory is only measured on unix
+    resource = None
+
+SOURCE_FP = Path(__file__).parent / "data" / "imdb" / "imdb_movies_data.csv"
+BENCHMARK_DIR = config["DATA_DIR"] / "benchmark"
+QUESTIONS = [
+    "Show how the average rating of movies has changed over time.",
+    "What are the 5 movies with the highest revenue?",
+    "Which director has directed the most movies?",
+]
+# The step of the data analyst that ends with each event
+STAGES = dict(
+    thought="plan",
+    sql="generate_sql",
+    result="run_sql",
+    plot_code="plot_code",
+    answer="answer",
+)
+
+
+class ReplayLLM:
+    """Fake llm answering with completions recorded in the completion cache. A
+    prompt that was not recorded, for instance because a scaled dataset gives other
+    query results, is answered with the recorded completion for the same stop
+    sequence whose prompt shares the longest prefix with it."""
+
+    def __init__(self, model="text-davinci-003", temperature=0, max_tokens=2_000):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.completions = {}  # hash_id -> completion
+        self.prompts = defaultdict(list)  # stop -> [(prompt, completion)]
+        for page in db_cache.crud_completion.iter_pages():
+            for row in page[page.model == model].itertuples():
+                self.completions[row.hash_id] = row.completion
+                self.prompts[row.stop].append((row.prompt, row.completion))
+        self.exact = 0
+        self.nearest = 0
+
+    def __call__(
+        self,
+        prompt: str,
+        stop: str = None,
+        log_completion: str = "",
+        temperature: float = None,
+        max_tokens: int = None,
+    ) -> str:
+        hash_id = db_cache.Completion.get_hash_id(
+            prompt=prompt,
+            stop=stop,
+            model=self.model,
+            temperature=self.temperature if temperature is None else temperature,
+            max_tokens=self.max_tokens if max_tokens is None else max_tokens,
+        )
+        if hash_id in self.completions:
+            self.exact += 1
+            return self.completions[hash_id]
+        recorded = self.prompts.get(stop)
+        if not recorded:
+            raise LookupError(f"No recorded completions with stop {stop!r}")
+        self.nearest += 1
+        _, completion = max(
+            recorded, key=lambda item: len(os.path.commonprefix([item[0], prompt]))
+        )
+        return completion
+
+    def stats(self) -> dict:
+        return dict(exact=self.exact, nearest=self.nearest)
+
+
+def make_dataset(scale: int) -> Path:
+    """Directory with the imdb dataset repeated `scale` times. The ranks of the
+    copies are offset, so they stay unique."""
+    data_dir = BENCHMARK_DIR / "datasets" / f"imdb_x{scale}"
+    fp = data_dir / SOURCE_FP.name
+    if not fp.exists():
+        data_dir.mkdir(parents=True, exist_ok=True)
+        tmp_fp = fp.with_suffix(".tmp")
+        source = f"read_csv_auto('{SOURCE_FP}')"
+        query = f"""SELECT src.* REPLACE (src.Rank + c.range * max_rank.n AS Rank)
+            FROM {source} AS src,
+                range({int(scale)}) AS c,
+                (SELECT max(Rank) AS n FROM {source}) AS max_rank
+            ORDER BY c.range, src.Rank"""
+        duckdb.connect().execute(
+            f"COPY ({query}) TO '{tmp_fp}' (HEADER, DELIMITER ',')"
+        )
+        os.replace(tmp_fp, fp)
+    return data_dir
+
+
+def run_scale(scale: int, questions: list[str], repeats: int) -> dict:
+    """Ingest the scaled dataset and answer the questions `repeats` times. Runs in
+    its own process with empty query result and figure caches, so the first repeat
+    is cold and the later ones show the effect of the caches."""
+    cache_dir = BENCHMARK_DIR / "cache" / f"imdb_x{scale}"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    result_cache.result_cache.cache_dir = cache_dir / "results"
+    plot_runner.cache_dir = cache_dir / "figures"
+
+    data_dir = make_dataset(scale)
+    manifest_fp = data_dir / data.MANIFEST_FILENAME
+    for fp in [manifest_fp, data_dir / "files_db.duckdb"]:
+        fp.unlink(missing_ok=True)
+    start = time.perf_counter()
+    data.Files(data_dir=data_dir, persist_data=True).save(str(manifest_fp))
+    ingest_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    data_fetcher = data.Files.load(str(manifest_fp), read_only=True)
+    load_seconds = time.perf_counter() - start
+
+    llm = ReplayLLM()
+    timings = defaultdict(list)
+    errors = []
+    for _ in range(repeats):
+        for question in questions:
+            start = last = time.perf_counter()
+            try:
+                for event in data_analyst_stream(
+                    question,
+                    openai_api_key=None,
+                    data_fetcher=data_fetcher,
+                    llm=llm,
+                    use_answer_cache=False,
+                ):
+                    now = time.perf_counter()
+                    timings[STAGES[event["type"]]].append(now - last)
+                    last = now
+                response = event["response"]
+                if response["action"]["tool"] == "Plot":
+                    action_data = response["action_data"]
+                    plot_runner.render(action_data["code"], action_data["data"])
+                    now = time.perf_counter()
+                    timings["render_plot"].append(now - last)
+            except Exception as e:
+                errors.append(f"{question}: {e}")
+                continue
+            timings["question"].append(time.perf_counter() - start)
+    plot_runner.close()
+
+    (num_rows,) = (
+        data_fetcher.cursor()
+        .execute("SELECT count(*) FROM imdb_movies_data")
+        .fetchone()
+    )
+    return dict(
+        scale=scale,
+        num_rows=num_rows,
+        ingest_seconds=ingest_seconds,
+        load_seconds=load_seconds,
+        peak_rss_bytes=_peak_rss_bytes(),
+        stages={stage: _summary(times) for stage, times in timings.items()},
+        cache=dict(
+            completions=llm.stats(),
+            results=result_cache.result_cache.stats(),
+            figures=plot_runner.memory_cache.stats(),
+        ),
+        errors=errors,
+    )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Timings and memory use that are more than `tolerance` (relative) above the
+    baseline"""
+    regressions = []
+    baseline_runs = {run["scale"]: run for run in baseline["runs"]}
+    for run in results["runs"]:
+        base = baseline_runs.get(run["scale"])
+        if base is None:
+            continue
+        metrics = [
+            (name, run[name], base[name])
+            for name in ["ingest_seconds", "load_seconds", "peak_rss_bytes"]
+        ] + [
+            (f"{stage} median", summary["median"], base["stages"][stage]["median"])
+            for stage, summary in run["stages"].items()
+            if stage in base["stages"]
+        ]
+        for name, value, base_value in metrics:
+            if base_value and value > base_value * (1 + tolerance):
+                regressions.append(
+                    f"x{run['scale']} {name}: {value:.4g} vs {base_value:.4g} "
+                    f"(+{100 * (value / base_value - 1):.0f}%)"
+                )
+    return regressions
+
+
+def _summary(times: list[float]) -> dict:
+    return dict(
+        n=len(times),
+        median=statistics.median(times),
+        mean=statistics.mean(times),
+        max=max(times),
+    )
+
+
+def _peak_rss_bytes() -> int:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _print_run(run: dict) -> None:
+    print(
+        f"x{run['scale']} ({run['num_rows']:,} rows): "
+        f"ingest {run['ingest_seconds']:.2f}s, load {run['load_seconds']:.3f}s, "
+        f"peak rss {(run['peak_rss_bytes'] or 0) / 1e6:,.0f} MB"
+    )
+    for stage, summary in run["stages"].items():
+        print(
+            f"  {stage:<13} median {1000 * summary['median']:8.1f} ms  "
+            f"max {1000 * summary['max']:8.1f} ms  (n={summary['n']})"
+        )
+    for name, stats in run["cache"].items():
+        print(f"  {name} cache: {stats}")
+    for error in run["errors"]:
+        print(f"  error: {error}")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the data analyst")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--questions", nargs="+", default=QUESTIONS)
+    parser.add_argument("--output", type=Path, help="File to save the results in")
+    parser.add_argument("--compare", type=Path, help="Results to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown reported as a regression",
+    )
+    args = parser.parse_args(args)
+
+    runs = []
+    for scale in args.scales:
+        # A fresh process per scale, so the peak memory is not carried over
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            run = executor.submit(run_scale, scale, args.questions, args.repeats)
+            runs.append(run.result())
+        _print_run(runs[-1])
+
+    results = dict(
+        created_at=datetime.utcnow().isoformat(),
+        questions=args.questions,
+        repeats=args.repeats,
+        runs=runs,
+    )
+    output = args.output or (
+        BENCHMARK_DIR / "results" / f"{datetime.utcnow():%Y%m%dT%H%M%S}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        regressions = compare(
+            results, json.loads(args.compare.read_text()), args.tolerance
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
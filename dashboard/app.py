@@ -1,5 +1,7 @@
 from dash import Dash
+from flask import Response
 import dash_bootstrap_components as dbc
+from ada.tracing import tracer
 
 CSS = [
     dbc.themes.BOOTSTRAP,
@@ -17,3 +19,11 @@ app = Dash(
     suppress_callback_exceptions=True,
 )
 server = app.server
+
+
+@server.route("/metrics")
+def metrics():
+    # Prometheus text format, summed over all worker processes
+    return Response(
+        tracer.metrics.to_prometheus(), mimetype="text/plain; version=0.0.4"
+    )
@@ -1,17 +1,20 @@
 from dash import html, dcc, Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 from dashboard.components import main_wrapper
 from dashboard.app import app, server
-import pandas as pd
-import ast
-from ada import data_analyst
+from ada import data_analyst_stream
 from dash import dcc, html, Input, Output
 from dotenv import dotenv_values
 import dash
+import uuid
 from dashboard import db
+from dashboard.jobs import jobs
 from ada import data
+from dashboard.plots import plot_runner
 
 data_dir = dotenv_values()["DATA_DIR"]
+db.create_db_and_tables()
 sidebar_context = {
     "/": {
         "title": "IMDB movies",
@@ -36,6 +39,7 @@ app.layout = html.Div(
             data=sidebar_context,
             storage_type="session",
         ),
+        dcc.Store("session-id", storage_type="session"),
     ]
 )
 
@@ -79,8 +83,10 @@ def layout(sidebar_context):
     )
     chat_window = dbc.Container(
         [
-            dcc.Store(id="store-conversation", data={"/": []}),
+            dcc.Store(id="analyst-job"),
+            dcc.Interval(id="analyst-poll", interval=500, disabled=True),
             conversation,
+            html.Div(id="analyst-progress"),
             controls,
             dbc.Spinner(html.Div(id="loading-component")),
         ],
@@ -92,72 +98,160 @@ def layout(sidebar_context):
     )
 
 
+@app.callback(
+    Output("session-id", "data"),
+    Input("session-id", "modified_timestamp"),
+    State("session-id", "data"),
+)
+def init_session(timestamp, session_id):
+    # The conversations are stored on the server under the id of the session
+    if session_id:
+        raise PreventUpdate
+    return uuid.uuid4().hex
+
+
 @app.callback(
     Output("display-conversation", "children"),
-    [Input("store-conversation", "data"), Input("urlNoRefresh", "pathname")],
+    [Input("urlNoRefresh", "pathname"), Input("session-id", "data")],
+    State("app-state", "data"),
 )
-def update_conversation(chats, pathname):
-    chat_history = chats[pathname]
-    return [
-        textbox(x, box="AI") if i % 2 == 0 else textbox(x, box="user")
-        for i, x in enumerate(chat_history)
-    ]
+def load_conversation(pathname, session_id, app_state):
+    if not session_id or pathname not in app_state:
+        raise PreventUpdate
+
+    messages = db.crud_message.list_messages(session_id, pathname)
+    # If the conversation is new, start it with a dataset introduction
+    if not messages:
+        with data.fetcher_pool.lease(app_state[pathname]["data_dir"]) as data_fetcher:
+            tables_info = data_fetcher.tables_info
+        introduction = f"Ask questions about the following table: {tables_info}"
+        response = dict(
+            action=dict(tool="Text", input=introduction), action_data=dict()
+        )
+        db.crud_message.create(session_id, pathname, "AI", response)
+        messages = [dict(role="AI", content=response)]
+    return [textbox(message["content"], box=message["role"]) for message in messages]
 
 
 @app.callback(
-    [Output("store-conversation", "data"), Output("loading-component", "children")],
+    [
+        Output("display-conversation", "children", allow_duplicate=True),
+        Output("loading-component", "children"),
+        Output("analyst-job", "data"),
+        Output("analyst-poll", "disabled"),
+    ],
     [Input("submit", "n_clicks"), Input("user-input", "n_submit")],
     [
         State("user-input", "value"),
-        State("store-conversation", "data"),
         State("openai-api-key", "data"),
         State("app-state", "data"),
-        Input("urlNoRefresh", "pathname"),
+        State("urlNoRefresh", "pathname"),
+        State("session-id", "data"),
+        State("analyst-job", "data"),
     ],
+    prevent_initial_call=True,
 )
 def answer_question(
-    n_clicks, n_submit, user_input, chats, openai_api_key, app_state, pathname
+    n_clicks,
+    n_submit,
+    user_input,
+    openai_api_key,
+    app_state,
+    pathname,
+    session_id,
+    running_job,
 ):
-    callback_trigger = dash.callback_context.triggered[0]["prop_id"]
-
-    # Get data fetcher and chat history
-    if pathname not in chats:
-        chats[pathname] = []
-    chat_history = chats[pathname]
-    data_fetcher_fp = app_state[pathname]["data_dir"] + "/data_fetcher.pkl"
-    data_fetcher = data.Files.load(fp=data_fetcher_fp)
-
-    # If the user has not entered any input, return dataset introduction
-    if n_clicks is None and n_submit is None and chat_history == []:
-        introduction = (
-            f"Ask questions about the following table: {data_fetcher.tables_info}"
-        )
-        response = dict(
-            action=dict(tool="Text", input=introduction), action_data=dict()
-        )
-        chat_history.append(response)
-    elif callback_trigger == "urlNoRefresh.pathname":
-        pass
-    else:
-        # If the user submitted an empty message return status quo
-        if user_input is None or user_input == "":
-            return chat_history, None
-
-        # Get data analyst response
-        response = data_analyst(
-            user_input,
-            openai_api_key=openai_api_key,
-            data_fetcher=data_fetcher,
+    # If the user submitted an empty message return status quo
+    if user_input is None or user_input == "":
+        return dash.no_update, None, None, True
+    # Only answer one question at a time
+    if running_job is not None:
+        text = "Please wait for the answer to the previous question."
+        response = dict(action=dict(tool="Text", input=text), action_data=dict())
+        conversation = dash.Patch()
+        conversation.append(textbox(response, box="AI"))
+        return conversation, None, running_job, False
+
+    # Run the data analyst in the background. The response is added to the
+    # conversation by `poll_data_analyst` when it is done.
+    job_id = jobs.submit(
+        answer_stream(user_input, openai_api_key, app_state[pathname]["data_dir"])
+    )
+    job = dict(id=job_id, session_id=session_id, pathname=pathname, question=user_input)
+    db.crud_message.create(session_id, pathname, "user", user_input)
+
+    # Only the new message is sent to the browser and appended to the conversation
+    conversation = dash.Patch()
+    conversation.append(textbox(user_input, box="user"))
+    return conversation, None, job, False
+
+
+def answer_stream(question: str, openai_api_key: str, data_dir: str):
+    """Events of the data analyst. The fetcher is leased from the pool while the
+    job runs, so the pool does not close it in the meantime."""
+    with data.fetcher_pool.lease(data_dir) as data_fetcher:
+        yield from data_analyst_stream(
+            question, openai_api_key=openai_api_key, data_fetcher=data_fetcher
         )
-        # Add the input and the response to the chat history
-        chat_history.append(user_input)
-        chat_history.append(response)
 
+
+@app.callback(
+    [
+        Output("display-conversation", "children", allow_duplicate=True),
+        Output("analyst-progress", "children"),
+        Output("analyst-job", "data", allow_duplicate=True),
+        Output("analyst-poll", "disabled", allow_duplicate=True),
+    ],
+    Input("analyst-poll", "n_intervals"),
+    [State("analyst-job", "data"), State("urlNoRefresh", "pathname")],
+    prevent_initial_call=True,
+)
+def poll_data_analyst(n_intervals, job, pathname):
+    if job is None:
+        return dash.no_update, None, None, True
+
+    status = jobs.poll(job["id"])
+    if not status["done"]:
+        return dash.no_update, progress_box(status["events"]), job, False
+
+    if status["error"]:
+        text = f"Something went wrong answering the question: {status['error']}"
+        response = dict(action=dict(tool="Text", input=text), action_data=dict())
+    else:
+        response = status["events"][-1]["response"]
         # Save the user input to the database
-        db.crud_question.create(db.Question(text=user_input))
+        db.crud_question.create(db.Question(text=job["question"]))
+    db.crud_message.create(job["session_id"], job["pathname"], "AI", response)
+
+    # The response is loaded from the database if the user has changed page
+    if pathname != job["pathname"]:
+        return dash.no_update, None, None, True
+    conversation = dash.Patch()
+    conversation.append(textbox(response, box="AI"))
+    return conversation, None, None, True
 
-    chats[pathname] = chat_history
-    return chats, None
+
+def progress_box(events):
+    """Show the steps the data analyst has taken so far"""
+    style = {
+        "max-width": "100%",
+        "padding": "5px 10px",
+        "margin-bottom": 20,
+        "background-color": "#f1f1f1",
+        "color": "#555555",
+        "font-size": "0.85rem",
+    }
+    steps = []
+    for event in events:
+        if event["type"] == "thought" and event["thought"]:
+            steps.append(html.P(event["thought"], className="mb-1"))
+        elif event["type"] == "sql":
+            steps.append(dcc.Markdown(f"```sql\n{event['sql'].strip()}\n```"))
+        elif event["type"] == "result":
+            steps.append(dcc.Markdown(event["preview"]))
+        elif event["type"] == "plot_code":
+            steps.append(html.P("Creating plot...", className="mb-1"))
+    return dbc.Card([dbc.Spinner(size="sm"), *steps], style=style, body=True)
 
 
 def textbox(input, box="AI"):
@@ -192,14 +286,12 @@ def textbox(input, box="AI"):
             style["color"] = "black"
             return dbc.Card(input, style=style, body=True, inverse=False)
         elif action["tool"] == "Plot":
-            df = pd.read_json(action_data["data"])
-            code = action_data["code"]
-
-            # Use ast to execute the code and extract the variable `fig`
-            node = ast.parse(code)
-            local_namespace = {"df": df}
-            exec(compile(node, "<ast>", "exec"), local_namespace)
-            fig = local_namespace.get("fig")
+            try:
+                fig = plot_runner.render(action_data["code"], action_data["data"])
+            except Exception as e:
+                style["background-color"] = "#d8d8d8"
+                text = f"The plot could not be created: {e}"
+                return dbc.Card(text, style=style, body=True, inverse=False)
             return dcc.Graph(figure=fig, style=style)
         else:
             raise ValueError("Incorrect tool in `action`.")
@@ -211,5 +303,5 @@ def textbox(input, box="AI"):
 if __name__ == "__main__":
     # upload_dir = "/root/ada/data/imdb"
     # data_agent = data.Files(data_dir=upload_dir)
-    # data_agent.save(upload_dir + "/data_fetcher.pkl")
+    # data_agent.save(upload_dir + "/data_fetcher.json")
     app.run_server(port=8050, debug=True)
@@ -1,13 +1,21 @@
 # flake8: noqa E501
 from dash import html, dcc, Input, Output, State
+from loguru import logger
 import base64
+import dash
 from dashboard.app import app
+from dashboard.jobs import ingestion_jobs
 import dash_bootstrap_components as dbc
 from ada.config import config
 from ada import data
+from ada.tracing import span
 import uuid
 from pathlib import Path
 
+# Number of base64 characters decoded at a time when writing an upload to disk.
+# Must be a multiple of 4.
+UPLOAD_CHUNK_SIZE = 16 * 2**20
+
 
 def main_wrapper(element, sidebar_context):
     return html.Div(
@@ -84,6 +92,8 @@ def upload_data_modal():
                         },
                     ),
                     html.Div(id="data-uploaded"),
+                    dcc.Store(id="upload-job"),
+                    dcc.Interval(id="upload-poll", interval=1000, disabled=True),
                 ],
             ),
             dbc.ModalFooter(
@@ -171,42 +181,114 @@ def update_upload_data_modal(button_upload, button_close, is_open):
 
 
 @app.callback(
-    [Output("data-uploaded", "children"), Output("app-state", "data")],
+    [
+        Output("data-uploaded", "children"),
+        Output("upload-job", "data"),
+        Output("upload-poll", "disabled"),
+    ],
     Input("upload-data-file", "contents"),
-    [State("upload-data-file", "filename"), State("app-state", "data")],
+    State("upload-data-file", "filename"),
     prevent_initial_call=True,
 )
-def save_uploaded_file_to_disk(content, filename, app_state):
+def save_uploaded_file_to_disk(content, filename):
     if content is None:
-        return html.H5("No file uploaded", style={"textAlign": "center"}), app_state
-
-    try:
-        # Dump data to disk
-        upload_dir = config["DATA_DIR"] / "uploaded_data" / str(uuid.uuid4())
-        upload_dir.mkdir()
-        data_uploaded = content.encode("utf8").split(b";base64,")[1]
-        with open(upload_dir / filename, "wb") as fp:
-            fp.write(base64.decodebytes(data_uploaded))
-
-        # Create data agent and save
-        data_fetcher = data.Files(data_dir=upload_dir, persist_data=True)
-        data_fetcher.save(str(upload_dir) + "/data_fetcher.pkl")
-
-        # Update app state
-        name = filename.split(".")[0]
-        href = "/" + name
-        app_state[href] = {
-            "title": name,
-            "href": href,
-            "icon": "fa-regular fa-message",
-            "data_dir": str(upload_dir),
-        }
-
-    except Exception as e:
-        print(e)
-        return html.H5(f"There was an error processing {filename}"), app_state
-
-    return (
-        html.H5(f"{filename} has been uploaded", style={"textAlign": "center"}),
-        app_state,
+        return html.H5("No file uploaded", style={"textAlign": "center"}), None, True
+
+    # The file is written and ingested in the background, so large uploads do not
+    # block the request. Progress is shown by `poll_upload`.
+    upload_dir = config["DATA_DIR"] / "uploaded_data" / str(uuid.uuid4())
+    upload_dir.mkdir(parents=True)
+    filename = Path(filename).name
+    job_id = ingestion_jobs.run(ingest_upload, content, filename, upload_dir)
+    job = dict(id=job_id, filename=filename, data_dir=str(upload_dir))
+    return upload_progress(filename, []), job, False
+
+
+@app.callback(
+    [
+        Output("data-uploaded", "children", allow_duplicate=True),
+        Output("app-state", "data"),
+        Output("upload-job", "data", allow_duplicate=True),
+        Output("upload-poll", "disabled", allow_duplicate=True),
+    ],
+    Input("upload-poll", "n_intervals"),
+    [State("upload-job", "data"), State("app-state", "data")],
+    prevent_initial_call=True,
+)
+def poll_upload(n_intervals, job, app_state):
+    if job is None:
+        return dash.no_update, dash.no_update, None, True
+
+    filename = job["filename"]
+    status = ingestion_jobs.poll(job["id"])
+    if not status["done"]:
+        return upload_progress(filename, status["events"]), dash.no_update, job, False
+
+    if status["error"]:
+        logger.error(f"Could not ingest {filename}: {status['error']}")
+        message = html.H5(f"There was an error processing {filename}")
+        return message, dash.no_update, None, True
+
+    # Update app state
+    name = filename.split(".")[0]
+    href = "/" + name
+    app_state[href] = {
+        "title": name,
+        "href": href,
+        "icon": "fa-regular fa-message",
+        "data_dir": job["data_dir"],
+    }
+    message = html.H5(f"{filename} has been uploaded", style={"textAlign": "center"})
+    return message, app_state, None, True
+
+
+def ingest_upload(content: str, filename: str, upload_dir: Path, emit) -> None:
+    """Decode the uploaded file to disk in chunks and load it into duckdb"""
+    start = content.index(";base64,") + len(";base64,")
+    num_bytes = 0
+    with open(upload_dir / filename, "wb") as fp:
+        for i in range(start, len(content), UPLOAD_CHUNK_SIZE):
+            num_bytes += fp.write(base64.b64decode(content[i : i + UPLOAD_CHUNK_SIZE]))
+            emit(dict(type="upload", num_bytes=num_bytes))
+
+    # Create data agent and save
+    with span("ingest", num_bytes=num_bytes) as attributes:
+        data_fetcher = data.Files(
+            data_dir=upload_dir,
+            persist_data=True,
+            on_progress=lambda progress: emit(dict(type="table", **progress)),
+        )
+        data_fetcher.save(str(upload_dir / data.MANIFEST_FILENAME))
+        attributes["tables"] = len(data_fetcher.tables)
+    # The dataset is opened read only by the fetcher pool when it is queried
+    data_fetcher.close()
+
+
+def upload_progress(filename: str, events: list[dict]) -> html.Div:
+    uploads = [event for event in events if event["type"] == "upload"]
+    tables = [event for event in events if event["type"] == "table"]
+    if tables:
+        steps = [
+            html.P(f"{table['table']}: {table['num_rows']:,} rows", className="mb-1")
+            for table in tables
+        ]
+        progress = 100 * tables[-1]["done"] / tables[-1]["total"]
+        text = f"Loading {filename}"
+    elif uploads:
+        steps, progress = [], None
+        text = f"Writing {filename} ({uploads[-1]['num_bytes'] / 1e6:,.1f} MB)"
+    else:
+        steps, progress = [], None
+        text = f"Writing {filename}"
+    return html.Div(
+        [
+            html.H5(text, style={"textAlign": "center"}),
+            dbc.Progress(
+                value=progress or 100,
+                striped=progress is None,
+                animated=progress is None,
+                className="mb-2",
+            ),
+            *steps,
+        ]
     )
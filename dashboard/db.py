@@ -4,7 +4,9 @@ from sqlalchemy.dialects.sqlite import insert
 from datetime import datetime, timedelta
 from typing import Optional
 from dotenv import dotenv_values
-from sqlalchemy import Column, DateTime
+from sqlalchemy import Column, DateTime, Text, event, update, delete, text
+from ada.locks import file_lock
+import json
 
 
 class Question(SQLModel, table=True):
@@ -39,6 +41,113 @@ class CRUDQuestion:
             session.exec(stmt)
 
 
+class Message(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    session_id: str = Field(index=True)
+    pathname: str
+    role: str
+    content: str = Field(sa_column=Column(Text, nullable=False))
+    created_at: Optional[datetime] = Field(
+        sa_column=Column(DateTime, default=datetime.utcnow, nullable=False)
+    )
+
+
+class CRUDMessage:
+    """Conversations are stored on the server, so the browser only has to keep a
+    session id. The content of a message is stored as json."""
+
+    def __init__(self, model: Message, engine):
+        self.model = model
+        self.engine = engine
+
+    def list_messages(self, session_id: str, pathname: str) -> list[dict]:
+        with Session(self.engine) as session:
+            stmt = (
+                select(Message.role, Message.content)
+                .where(Message.session_id == session_id)
+                .where(Message.pathname == pathname)
+                .order_by(Message.id)
+            )
+            return [
+                dict(role=role, content=json.loads(content))
+                for role, content in session.exec(stmt)
+            ]
+
+    def create(self, session_id: str, pathname: str, role: str, content) -> None:
+        with Session(self.engine) as session, session.begin():
+            session.add(
+                Message(
+                    session_id=session_id,
+                    pathname=pathname,
+                    role=role,
+                    content=json.dumps(content),
+                )
+            )
+
+
+class Job(SQLModel, table=True):
+    id: str = Field(primary_key=True)
+    started_at: Optional[datetime] = Field(default_factory=datetime.utcnow)
+    done: bool = False
+    error: Optional[str] = None
+    finished_at: Optional[datetime] = Field(default=None, index=True)
+
+
+class JobEvent(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    job_id: str = Field(index=True)
+    event: str = Field(sa_column=Column(Text, nullable=False))
+
+
+class CRUDJob:
+    """Background jobs and the events they have yielded. Jobs are stored in the
+    database, so they can be polled from every worker process and not only the
+    one running the job."""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def create(self, job_id: str) -> None:
+        with Session(self.engine) as session, session.begin():
+            session.add(Job(id=job_id))
+
+    def add_event(self, job_id: str, event: dict) -> None:
+        with Session(self.engine) as session, session.begin():
+            session.add(JobEvent(job_id=job_id, event=json.dumps(event)))
+
+    def finish(self, job_id: str, error: str = None) -> None:
+        with Session(self.engine) as session, session.begin():
+            stmt = (
+                update(Job)
+                .where(Job.id == job_id)
+                .values(done=True, error=error, finished_at=datetime.utcnow())
+            )
+            session.exec(stmt)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with Session(self.engine) as session:
+            job = session.get(Job, job_id)
+            if job is None:
+                return None
+            stmt = (
+                select(JobEvent.event)
+                .where(JobEvent.job_id == job_id)
+                .order_by(JobEvent.id)
+            )
+            events = [json.loads(event) for event in session.exec(stmt)]
+            return dict(
+                events=events, done=job.done, error=job.error, started_at=job.started_at
+            )
+
+    def delete_finished(self, before: datetime) -> None:
+        with Session(self.engine) as session, session.begin():
+            stmt = select(Job.id).where(Job.finished_at < before)
+            job_ids = list(session.exec(stmt))
+            if job_ids:
+                session.exec(delete(JobEvent).where(JobEvent.job_id.in_(job_ids)))
+                session.exec(delete(Job).where(Job.id.in_(job_ids)))
+
+
 config = dotenv_values()
 sqlite_fp = Path(config["DATA_DIR"]) / "databases" / "db.sqlite"
 sqlite_url = f"sqlite:///{str(sqlite_fp)}"
@@ -46,8 +155,31 @@ connect_args = {"check_same_thread": False}
 engine = create_engine(sqlite_url, echo=False, connect_args=connect_args)
 
 
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    # Every worker process of the dashboard runs this when it starts
+    with file_lock(sqlite_fp.with_suffix(".lock")):
+        SQLModel.metadata.create_all(engine)
+        migrate_job_table()
+
+
+def migrate_job_table():
+    """Add the start time to job tables created before jobs could time out. Jobs
+    without a start time never time out."""
+    with engine.begin() as con:
+        columns = {row[1] for row in con.execute(text("PRAGMA table_info(job)"))}
+        if "started_at" not in columns:
+            con.execute(text("ALTER TABLE job ADD COLUMN started_at DATETIME"))
 
 
 crud_question = CRUDQuestion(Question, engine)
+crud_message = CRUDMessage(Message, engine)
+crud_job = CRUDJob(engine)
@@ -0,0 +1,45 @@
+"""Gunicorn settings for running the dashboard on all cores of a machine
+
+    gunicorn -c dashboard/gunicorn.conf.py dashboard.chat:server
+
+Every worker process has its own fetchers, plot workers and in-memory caches,
+while the sqlite database, the duckdb files and the result caches on disk are
+shared between them.
+"""
+
+import os
+from ada.config import config
+
+bind = config.get("DASHBOARD_BIND", "0.0.0.0:8050")
+workers = int(config.get("DASHBOARD_WORKERS", os.cpu_count()))
+# Callbacks mostly wait on openai and duckdb, so each worker serves several
+# requests at a time
+worker_class = "gthread"
+threads = int(config.get("DASHBOARD_THREADS", 4))
+timeout = 120
+# The app is imported in each worker and not before forking, so no duckdb or
+# sqlite connections are shared between processes
+preload_app = False
+
+
+def on_starting(server):
+    from ada import db_cache
+    from ada.tracing import tracer
+    from dashboard import db
+
+    db_cache.create_db_and_tables()
+    db.create_db_and_tables()
+    # Start the metrics from zero instead of adding to those of earlier runs
+    tracer.metrics.clear()
+    # Close the connections before the workers are forked
+    db_cache.engine.dispose()
+    db.engine.dispose()
+
+
+def post_fork(server, worker):
+    from ada import data
+
+    # Share the cores between the workers instead of every duckdb connection
+    # using all of them
+    if not data.QUERY_LIMITS["threads"]:
+        data.QUERY_LIMITS["threads"] = max(1, os.cpu_count() // workers)
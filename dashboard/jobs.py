@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Iterator
+import uuid
+from ada.config import config
+from dashboard import db
+
+
+class Jobs:
+    """Run generators in background threads and collect the events they yield, so
+    callbacks can return right away and poll for progress. The events are stored
+    in the database, so a job can be polled from any worker process.
+
+    A job still running after `timeout` seconds is reported as failed, since the
+    worker process running it may have died or been restarted without finishing
+    it."""
+
+    def __init__(
+        self, max_workers: int = 8, keep_for: float = 3600, timeout: float = None
+    ):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self.keep_for = keep_for
+        self.timeout = timeout
+
+    def submit(self, events: Iterator[dict]) -> str:
+        job_id = self._add_job()
+        self.executor.submit(self._run, job_id, events)
+        return job_id
+
+    def run(self, fn: Callable, *args) -> str:
+        """Run `fn(*args, emit=emit)` in the background, where `emit` adds an event
+        to the job. For work that reports progress through a callback."""
+        job_id = self._add_job()
+        self.executor.submit(self._run_fn, job_id, fn, args)
+        return job_id
+
+    def poll(self, job_id: str) -> dict:
+        """Events yielded so far and whether the job is done. Unknown jobs and jobs
+        running for longer than the timeout are reported as done with an error."""
+        job = db.crud_job.get(job_id)
+        if job is None:
+            return dict(events=[], done=True, error="Unknown job")
+        if not job["done"] and self._timed_out(job):
+            error = f"The job did not finish within {self.timeout:g} seconds"
+            db.crud_job.finish(job_id, error=error)
+            return dict(job, done=True, error=error)
+        return job
+
+    def _timed_out(self, job: dict) -> bool:
+        if not self.timeout or job["started_at"] is None:
+            return False
+        return job["started_at"] < datetime.utcnow() - timedelta(seconds=self.timeout)
+
+    def _add_job(self) -> str:
+        job_id = str(uuid.uuid4())
+        db.crud_job.delete_finished(
+            before=datetime.utcnow() - timedelta(seconds=self.keep_for)
+        )
+        db.crud_job.create(job_id)
+        return job_id
+
+    def _run(self, job_id: str, events: Iterator[dict]) -> None:
+        def consume(emit):
+            for event in events:
+                emit(event)
+
+        self._run_fn(job_id, consume, ())
+
+    def _run_fn(self, job_id: str, fn: Callable, args: tuple) -> None:
+        def emit(event: dict) -> None:
+            db.crud_job.add_event(job_id, event)
+
+        try:
+            fn(*args, emit=emit)
+        except Exception as e:
+            db.crud_job.finish(job_id, error=str(e))
+        else:
+            db.crud_job.finish(job_id)
+
+
+jobs = Jobs(timeout=float(config.get("JOB_TIMEOUT", 600)))
+# Uploads are ingested in a separate pool, so they do not hold up answers
+ingestion_jobs = Jobs(
+    max_workers=2, timeout=float(config.get("INGESTION_JOB_TIMEOUT", 3600))
+)
@@ -0,0 +1,164 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import pandas as pd
+import ast
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import threading
+from ada.config import config
+from ada.db_cache import LRUCache
+from ada.result_cache import result_store, evict_lru_files
+from ada.tracing import span
+
+try:
+    import resource
+except ImportError:  # Resource limits are only available on unix
+    resource = None
+
+# Results with more rows are downsampled before plotting
+PLOT_MAX_ROWS = 10_000
+
+
+class PlotRunner:
+    """Run generated plot code in a pool of worker processes with limits on wall
+    clock time, cpu time and memory. The figures are cached as json keyed by the
+    code and the data, so re-rendering a conversation or plotting the same result
+    in another answer does not run the code again. Result ids are hashes of the
+    results, so they identify the data.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_workers: int = 2,
+        timeout: float = 10,
+        memory_bytes: int = 2_000_000_000,
+        max_cache_bytes: int = 500_000_000,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_bytes = memory_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.memory_cache = LRUCache(max_size=256, ttl=24 * 3_600)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def render(self, code: str, data) -> dict:
+        """Plotly figure made by running `code` on the dataframe `df` loaded from
+        the result handle (or json) `data`"""
+        data_key = data["result_id"] if isinstance(data, dict) else data
+        key = hashlib.sha256(f"{code}{data_key}".encode("utf8")).hexdigest()
+        with span("plot") as attributes:
+            attributes["cache"] = "memory"
+            fig_json = self.memory_cache.get(key)
+            if fig_json is None:
+                fp = self.cache_dir / f"{key}.json"
+                try:
+                    attributes["cache"] = "disk"
+                    fig_json = fp.read_text()
+                    os.utime(fp)
+                except FileNotFoundError:
+                    attributes["cache"] = "miss"
+                    fig_json = self._run(code, data)
+                    self._write_cache(fp, fig_json)
+                self.memory_cache.set(key, fig_json)
+        return json.loads(fig_json)
+
+    def _run(self, code: str, data) -> str:
+        executor = self._get_executor()
+        future = executor.submit(_run_plot_code, code, data, self.timeout)
+        try:
+            return future.result(timeout=self.timeout + 5)
+        except BrokenProcessPool:
+            # A worker was killed, most likely by exceeding the cpu limit. The
+            # remaining workers of the broken pool are shut down.
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise RuntimeError("The plot code exceeded its resource limits")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Spawned workers start with a fresh address space, which the
+                # memory limit applies to
+                self._executor = ProcessPoolExecutor(
+                    self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_limit_memory,
+                    initargs=(self.memory_bytes,),
+                )
+            return self._executor
+
+    def close(self) -> None:
+        """Shut down the worker processes. They are started again when needed."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _write_cache(self, fp: Path, fig_json: str) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_fp = fp.with_suffix(f".{os.getpid()}.tmp")
+        tmp_fp.write_text(fig_json)
+        os.replace(tmp_fp, fp)
+        with self._lock:
+            evict_lru_files(self.cache_dir, "*.json", self.max_cache_bytes)
+
+
+def load_result(data) -> pd.DataFrame:
+    """Get the dataframe a result handle refers to. Conversations stored before
+    results were kept on the server hold the data as json."""
+    if isinstance(data, str):
+        return pd.read_json(data)
+    table = result_store.get(data["result_id"], max_rows=PLOT_MAX_ROWS)
+    if table is None:
+        raise ValueError("The data for this plot is no longer available.")
+    return table.to_pandas()
+
+
+def _limit_memory(memory_bytes: int) -> None:
+    if resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def _run_plot_code(code: str, data, timeout: float) -> str:
+    """Run in a worker process. The cpu limit is relative to the cpu time the
+    worker has already used, since workers are reused between plots."""
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_limit = int(usage.ru_utime + usage.ru_stime + timeout) + 1
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_CPU)
+        if hard_limit != resource.RLIM_INFINITY:
+            cpu_limit = min(cpu_limit, hard_limit)
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, hard_limit))
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        # Use ast to execute the code and extract the variable `fig`
+        node = ast.parse(code)
+        local_namespace = {"df": load_result(data)}
+        exec(compile(node, "<ast>", "exec"), local_namespace)
+        return local_namespace["fig"].to_json()
+    finally:
+        if hasattr(signal, "SIGALRM"):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("The plot code took too long to run")
+
+
+plot_runner = PlotRunner(
+    cache_dir=config["DATA_DIR"] / "cache" / "figures",
+    max_workers=int(config.get("PLOT_WORKERS", 2)),
+    timeout=float(config.get("PLOT_TIMEOUT", 10)),
+    memory_bytes=int(config.get("PLOT_MEMORY_BYTES", 2_000_000_000)),
+)
@@ -0,0 +1,33 @@
+from pathlib import Path
+import shutil
+import tempfile
+import pytest
+from ada.config import config
+
+# The caches and the completion database are created in DATA_DIR when their
+# modules are imported, so it is replaced before any test imports them
+config["DATA_DIR"] = Path(tempfile.mkdtemp(prefix="ada-tests-"))
+(config["DATA_DIR"] / "databases").mkdir()
+
+IMDB_CSV = Path(__file__).parents[1] / "data" / "imdb" / "imdb_movies_data.csv"
+
+
+@pytest.fixture(scope="session")
+def db():
+    from ada import db_cache
+
+    db_cache.create_db_and_tables()
+    return db_cache
+
+
+@pytest.fixture
+def imdb_dir(tmp_path) -> Path:
+    """Data directory holding a copy of the imdb movies csv"""
+    data_dir = tmp_path / "imdb"
+    data_dir.mkdir()
+    shutil.copy(IMDB_CSV, data_dir)
+    return data_dir
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(config["DATA_DIR"], ignore_errors=True)
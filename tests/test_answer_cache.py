@@ -0,0 +1,59 @@
+import uuid
+import pytest
+from ada.answer_cache import AnswerCache, normalize_question
+
+RESPONSE = dict(action=dict(tool="Text", output="42"), data_sql=None, code=None)
+
+
+@pytest.fixture
+def cache(db):
+    return AnswerCache(threshold=0.9)
+
+
+@pytest.fixture
+def fingerprint():
+    return uuid.uuid4().hex
+
+
+def test_normalize_question():
+    assert normalize_question("What's the avg rating per year?") == (
+        normalize_question("Show the average ratings by year")
+    )
+    assert normalize_question("Which genres haven't changed?").endswith("not changed")
+
+
+@pytest.mark.parametrize(
+    "question, similar",
+    [
+        ("avg rating per year", "What is the average rating by year?"),
+        ("Show the highest revenue of each genre", "max revenue per genre"),
+        ("Number of movies by director", "num of movies per director"),
+    ],
+)
+def test_similar_questions_match(cache, fingerprint, question, similar):
+    cache.set(question, fingerprint, RESPONSE)
+    assert cache.get(similar, fingerprint) == RESPONSE
+
+
+@pytest.mark.parametrize(
+    "question, other",
+    [
+        (
+            "number of movies produced in usa per year",
+            "number of movies produced in uk per year",
+        ),
+        ("movies sorted by rating ascending", "movies sorted by rating descending"),
+        ("top 5 directors by revenue", "top 10 directors by revenue"),
+        ("genres whose rating has changed", "genres whose rating hasn't changed"),
+        ("directors with the most movies", "directors with the fewest movies"),
+        ("average rating of comedies", "average rating of dramas"),
+    ],
+)
+def test_different_questions_do_not_match(cache, fingerprint, question, other):
+    cache.set(question, fingerprint, RESPONSE)
+    assert cache.get(other, fingerprint) is None
+
+
+def test_answers_are_kept_per_fingerprint(cache, fingerprint):
+    cache.set("avg rating per year", fingerprint, RESPONSE)
+    assert cache.get("avg rating per year", uuid.uuid4().hex) is None
@@ -0,0 +1,82 @@
+import pytest
+from ada import data
+from ada.data import Files
+
+CROSS_JOIN = "SELECT a.*, b.* FROM imdb_movies_data a, imdb_movies_data b"
+CROSS_JOIN_3 = CROSS_JOIN.replace("b.* FROM", "b.*, c.* FROM") + ", imdb_movies_data c"
+
+
+@pytest.fixture
+def files(imdb_dir) -> Files:
+    return Files(data_dir=str(imdb_dir), persist_data=True)
+
+
+def test_exec_sql(files):
+    df = files.exec_sql("SELECT count(*) AS n FROM imdb_movies_data")
+    assert df["n"][0] == 1000
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        CROSS_JOIN_3,
+        f"-- Every combination\n{CROSS_JOIN_3}",
+        f"/* Every combination */ {CROSS_JOIN_3}",
+        f"({CROSS_JOIN_3})",
+    ],
+)
+def test_queries_with_too_many_estimated_rows_are_rejected(files, sql):
+    with pytest.raises(ValueError, match="Query rejected"):
+        files.exec_sql_arrow(sql)
+
+
+def test_results_over_max_result_rows_raise(imdb_dir):
+    files = Files(data_dir=str(imdb_dir), max_result_rows=999)
+    for sql in [
+        "SELECT * FROM imdb_movies_data",
+        "-- All movies\nSELECT * FROM imdb_movies_data",
+    ]:
+        with pytest.raises(ValueError, match="exceeds the limit of 999 rows"):
+            files.exec_sql_arrow(sql)
+    assert files.exec_sql_arrow("SELECT * FROM imdb_movies_data", limit=5).num_rows == 5
+    assert files.exec_sql_arrow("SELECT * FROM imdb_movies_data LIMIT 999")
+
+
+def test_slow_queries_time_out(imdb_dir):
+    files = Files(data_dir=str(imdb_dir), timeout=0.3, max_result_rows=10**7)
+    with pytest.raises(TimeoutError):
+        files.exec_sql_arrow(CROSS_JOIN, use_cache=False)
+
+
+def test_preview_summarizes_results_longer_than_the_head(files):
+    preview = files.preview("SELECT year, title FROM imdb_movies_data", n_rows=5)
+    assert preview["head"].num_rows == 5
+    assert preview["num_rows"] == 1000
+    year = next(col for col in preview["columns"] if col["name"] == "year")
+    assert (year["min"], year["max"], year["nulls"]) == (2006, 2016, 0)
+
+
+def test_preview_of_a_short_result_runs_the_query_once(files, monkeypatch):
+    queries = []
+    exec_sql_arrow = files.exec_sql_arrow
+    monkeypatch.setattr(
+        files,
+        "exec_sql_arrow",
+        lambda sql, **kwargs: queries.append(sql) or exec_sql_arrow(sql, **kwargs),
+    )
+    preview = files.preview(
+        "SELECT year, count(*) AS n FROM imdb_movies_data GROUP BY year", n_rows=20
+    )
+    assert preview["num_rows"] == preview["head"].num_rows == 11
+    assert len(queries) == 1
+
+
+def test_tables_info_counts_distinct_values_exactly(files):
+    assert "director (VARCHAR, 644 distinct)" in files.tables_info
+    assert "year (BIGINT, 2006 to 2016, 11 distinct)" in files.tables_info
+
+
+def test_tables_info_marks_approximate_distinct_counts(imdb_dir, monkeypatch):
+    monkeypatch.setattr(data, "EXACT_DISTINCT_MAX_ROWS", 100)
+    files = Files(data_dir=str(imdb_dir))
+    assert "director (VARCHAR, ~" in files.tables_info
@@ -0,0 +1,88 @@
+import math
+import pandas as pd
+import pytest
+import sqlalchemy
+import sqlite3
+from ada.data import Database
+from ada.result_cache import result_cache
+from conftest import IMDB_CSV
+
+COUNT_BY_YEAR = "SELECT year, count(*) AS n FROM movies GROUP BY year ORDER BY year"
+
+
+@pytest.fixture(scope="module")
+def sqlite_url(tmp_path_factory) -> str:
+    fp = tmp_path_factory.mktemp("sqlite") / "movies.sqlite"
+    with sqlite3.connect(fp) as con:
+        pd.read_csv(IMDB_CSV).to_sql("movies", con, index=False)
+        pd.DataFrame({"name": ["a", "b"]}).to_sql("genres", con, index=False)
+    return f"sqlite:///{fp}"
+
+
+@pytest.fixture
+def database(sqlite_url):
+    database = Database(sqlite_url, chunk_size=100)
+    yield database
+    database.close()
+
+
+def test_schema(database):
+    assert database.tables == ["genres", "movies"]
+    assert "Table 'movies' has columns: Rank (INTEGER)" in database.tables_info
+    assert database.relevant_tables("Which director made most movies?", k=1) == [
+        "movies"
+    ]
+
+
+def test_results_are_collected_from_chunks(database):
+    df = database.exec_sql("SELECT * FROM movies", use_cache=False)
+    assert len(df) == 1000
+    df = database.exec_sql(COUNT_BY_YEAR, use_cache=False)
+    assert df["year"].tolist() == list(range(2006, 2017))
+    assert df["n"].sum() == 1000
+
+
+def test_limits(sqlite_url):
+    database = Database(sqlite_url, max_result_rows=999)
+    assert database.exec_sql_arrow("SELECT * FROM movies", limit=5).num_rows == 5
+    with pytest.raises(ValueError, match="exceeds the limit of 999 rows"):
+        database.exec_sql_arrow("-- All movies\nSELECT * FROM movies")
+    database.close()
+
+
+def test_empty_results_keep_their_columns(database):
+    table = database.exec_sql_arrow("SELECT title FROM movies WHERE 0")
+    assert table.num_rows == 0 and table.column_names == ["title"]
+
+
+def test_explain(database):
+    assert database.explain(COUNT_BY_YEAR) == math.inf
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        database.explain("SELECT missing FROM movies")
+
+
+def test_results_are_cached_within_the_ttl_period(sqlite_url):
+    database = Database(sqlite_url, cache_ttl=3600)
+    assert database.data_version.startswith(database.schema_version)
+    hits = result_cache.hits
+    database.exec_sql_arrow(COUNT_BY_YEAR)
+    database.exec_sql_arrow(COUNT_BY_YEAR)
+    assert result_cache.hits == hits + 1
+    database.close()
+
+
+def test_results_are_not_cached_without_a_ttl(sqlite_url):
+    database = Database(sqlite_url, cache_ttl=0)
+    assert database.data_version is None
+    hits = result_cache.hits
+    database.exec_sql_arrow(COUNT_BY_YEAR)
+    database.exec_sql_arrow(COUNT_BY_YEAR)
+    assert result_cache.hits == hits
+    database.close()
+
+
+def test_preview(database):
+    preview = database.preview("SELECT year, title FROM movies", n_rows=5)
+    assert (preview["head"].num_rows, preview["num_rows"]) == (5, 1000)
+    year = next(col for col in preview["columns"] if col["name"] == "year")
+    assert (year["min"], year["max"]) == (2006, 2016)
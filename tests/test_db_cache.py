@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from sqlmodel import SQLModel, create_engine
+from ada.db_cache import Completion, CRUDCompletion, LRUCache
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+
+@pytest.fixture
+def crud(engine):
+    return CRUDCompletion(Completion, engine)
+
+
+def completion(i: int, model: str = "text-davinci-003", **kwargs) -> Completion:
+    return Completion(
+        prompt=f"prompt {i} " * 10,
+        stop="\nObservation:",
+        model=model,
+        max_tokens=256,
+        temperature=0,
+        completion=f"completion {i}",
+        **kwargs,
+    )
+
+
+def hash_ids(engine) -> set[str]:
+    with engine.connect() as con:
+        return {row[0] for row in con.execute(text("SELECT hash_id FROM completion"))}
+
+
+def test_completions_are_stored_compressed(crud, engine):
+    crud.create(completion(1))
+    assert crud.get(completion(1).hash_id).completion == "completion 1"
+    with engine.connect() as con:
+        types = con.execute(text("SELECT typeof(prompt) FROM completion")).all()
+    assert types == [("blob",)]
+
+
+def test_evict_keeps_the_most_recently_used(crud, engine):
+    now = datetime.utcnow()
+    for i in range(5):
+        crud.create(completion(i, last_hit_at=now - timedelta(hours=5 - i)))
+    assert crud.evict(max_rows=2) == 3
+    assert hash_ids(engine) == {completion(3).hash_id, completion(4).hash_id}
+
+
+def test_evict_by_size(crud, engine):
+    now = datetime.utcnow()
+    for i in range(5):
+        crud.create(completion(i, last_hit_at=now - timedelta(hours=5 - i)))
+    # The stored size is that of the compressed text
+    with engine.connect() as con:
+        sizes = con.execute(
+            text("SELECT length(prompt) + length(completion) FROM completion")
+        ).all()
+    assert crud.evict(max_bytes=2 * max(size for (size,) in sizes)) == 3
+    assert hash_ids(engine) == {completion(3).hash_id, completion(4).hash_id}
+
+
+def test_evict_by_model_ttl(crud, engine):
+    old = datetime.utcnow() - timedelta(days=10)
+    crud.create(completion(1, model="old-model", last_hit_at=old))
+    crud.create(completion(2, model="text-davinci-003", last_hit_at=old))
+    crud.create(completion(3, model="old-model"))
+    assert crud.evict(model_ttls={"old-model": timedelta(days=1)}) == 1
+    assert hash_ids(engine) == {
+        completion(2).hash_id,
+        completion(3, model="old-model").hash_id,
+    }
+
+
+def test_compress_all_compresses_text_rows(crud, engine):
+    stored = [completion(i) for i in range(3)]
+    with engine.begin() as con:
+        for c in stored:
+            con.execute(
+                text(
+                    "INSERT INTO completion (hash_id, prompt, stop, model, max_tokens,"
+                    " temperature, completion, created_at) VALUES (:hash_id, :prompt,"
+                    " :stop, :model, :max_tokens, :temperature, :completion,"
+                    " :created_at)"
+                ),
+                dict(c.dict(), created_at=str(c.created_at)),
+            )
+    # Rows stored before compression are read as they are
+    assert crud.get(stored[0].hash_id).prompt == stored[0].prompt
+    assert crud.compress_all(batch_size=2) == 3
+    assert crud.compress_all() == 0
+    with engine.connect() as con:
+        types = con.execute(text("SELECT DISTINCT typeof(prompt) FROM completion"))
+        assert types.all() == [("blob",)]
+    assert [crud.get(c.hash_id).prompt for c in stored] == [c.prompt for c in stored]
+
+
+def test_lru_cache_evicts_the_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
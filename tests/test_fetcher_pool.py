@@ -0,0 +1,99 @@
+import json
+import shutil
+import pytest
+from ada.data import MANIFEST_FILENAME, FetcherPool, Files
+
+COUNT = "SELECT count(*) AS n FROM imdb_movies_data"
+
+
+@pytest.fixture
+def pool():
+    pool = FetcherPool(max_size=1)
+    yield pool
+    pool.close()
+
+
+def count(fetcher) -> int:
+    return int(fetcher.exec_sql(COUNT, use_cache=False)["n"][0])
+
+
+def test_leases_share_the_fetcher(pool, imdb_dir):
+    with pool.lease(imdb_dir) as fetcher, pool.lease(imdb_dir) as other:
+        assert fetcher is other
+        assert count(fetcher) == 1000
+    assert (imdb_dir / MANIFEST_FILENAME).exists()
+
+
+def test_evicted_fetchers_are_closed_when_released(pool, imdb_dir, tmp_path):
+    other_dir = tmp_path / "other"
+    shutil.copytree(imdb_dir, other_dir)
+    with pool.lease(imdb_dir) as fetcher:
+        with pool.lease(other_dir):
+            pass
+        # Evicted from the pool of one fetcher, but still leased
+        assert count(fetcher) == 1000
+    assert fetcher.con is None
+
+
+def test_changed_files_are_re_ingested(pool, imdb_dir):
+    with pool.lease(imdb_dir) as fetcher:
+        version = fetcher.schema_version
+    pool.close()
+    (imdb_dir / "extra.csv").write_text("a,b\n1,2\n")
+    with pool.lease(imdb_dir) as fetcher:
+        assert fetcher.tables == ["extra", "imdb_movies_data"]
+        assert fetcher.schema_version != version
+
+
+def test_leased_fetcher_keeps_serving_its_data_when_files_change(pool, imdb_dir):
+    with pool.lease(imdb_dir) as fetcher:
+        pool.close(imdb_dir)
+        (imdb_dir / "extra.csv").write_text("a,b\n1,2\n")
+        # The database is still open read-only, so the old manifest is used
+        with pool.lease(imdb_dir) as reloaded:
+            assert reloaded.tables == ["imdb_movies_data"]
+            assert count(reloaded) == count(fetcher) == 1000
+    # Once no fetcher has the database open, the files are re-ingested
+    pool.close()
+    with pool.lease(imdb_dir) as fetcher:
+        assert fetcher.tables == ["extra", "imdb_movies_data"]
+
+
+def test_unchanged_tables_are_reused(imdb_dir, monkeypatch):
+    Files(data_dir=str(imdb_dir)).save(imdb_dir / MANIFEST_FILENAME)
+    (imdb_dir / "extra.csv").write_text("a,b\n1,2\n")
+    ingested = []
+    ingest_table = Files._ingest_table
+    monkeypatch.setattr(
+        Files,
+        "_ingest_table",
+        lambda self, path, name: ingested.append(name)
+        or ingest_table(self, path, name),
+    )
+    files = Files(data_dir=str(imdb_dir))
+    assert ingested == ["extra"]
+    assert count(files) == 1000
+
+
+def test_manifests_of_other_versions_are_outdated(imdb_dir):
+    manifest_fp = imdb_dir / MANIFEST_FILENAME
+    Files(data_dir=str(imdb_dir)).save(manifest_fp)
+    assert not Files.is_outdated(manifest_fp)
+    manifest = json.loads(manifest_fp.read_text())
+    manifest["version"] = 1
+    del manifest["column_stats"]
+    manifest_fp.write_text(json.dumps(manifest))
+    assert Files.is_outdated(manifest_fp)
+    # Tables of the old manifest are reused and its statistics recomputed
+    files = Files(data_dir=str(imdb_dir))
+    assert files.column_stats["imdb_movies_data"]["num_rows"] == 1000
+
+
+def test_moved_data_directories_load(imdb_dir, tmp_path):
+    Files(data_dir=str(imdb_dir)).save(imdb_dir / MANIFEST_FILENAME)
+    moved = shutil.move(imdb_dir, tmp_path / "moved")
+    manifest_fp = moved / MANIFEST_FILENAME
+    assert not Files.is_outdated(manifest_fp)
+    files = Files.load(manifest_fp, read_only=True)
+    assert count(files) == 1000
+    files.close()
@@ -0,0 +1,68 @@
+import time
+import openai
+import pytest
+from ada.llm_client import CompletionClient
+
+RESPONSE = dict(
+    choices=[dict(text=" SELECT 1")],
+    usage=dict(prompt_tokens=3, completion_tokens=2),
+)
+
+
+@pytest.fixture
+def fake_acreate(monkeypatch):
+    """Replace the completion endpoint with one raising the queued errors before
+    it responds. The keyword arguments of each call are recorded."""
+    calls, errors = [], []
+
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        if errors:
+            raise errors.pop(0)
+        return RESPONSE
+
+    monkeypatch.setattr(openai.Completion, "acreate", acreate)
+    return calls, errors
+
+
+def rate_limit_error():
+    return openai.error.RateLimitError("Rate limit reached", http_status=429)
+
+
+def test_rate_limit_errors_are_retried(fake_acreate):
+    calls, errors = fake_acreate
+    errors += [rate_limit_error(), rate_limit_error()]
+    client = CompletionClient(max_retries=2, backoff=0)
+    assert client.complete(prompt="q", max_tokens=5) == " SELECT 1"
+    assert len(calls) == 3
+    assert calls[-1]["prompt"] == "q" and calls[-1]["max_tokens"] == 5
+
+
+def test_gives_up_after_max_retries(fake_acreate):
+    calls, errors = fake_acreate
+    errors += [rate_limit_error() for _ in range(4)]
+    client = CompletionClient(max_retries=2, backoff=0)
+    with pytest.raises(openai.error.RateLimitError):
+        client.complete(prompt="q", max_tokens=5)
+    assert len(calls) == 3
+
+
+def test_invalid_requests_are_not_retried(fake_acreate):
+    calls, errors = fake_acreate
+    errors.append(openai.error.InvalidRequestError("Too many tokens", "prompt"))
+    client = CompletionClient(max_retries=2, backoff=0)
+    with pytest.raises(openai.error.InvalidRequestError):
+        client.complete(prompt="q", max_tokens=5)
+    assert len(calls) == 1
+
+
+def test_requests_are_throttled_by_the_bucket(fake_acreate):
+    calls, _ = fake_acreate
+    # Ten requests per second once the burst allowance is used up
+    client = CompletionClient(requests_per_minute=600, backoff=0)
+    client.request_bucket.tokens = 0
+    start = time.monotonic()
+    for _ in range(3):
+        client.complete(prompt="q", max_tokens=5)
+    assert len(calls) == 3
+    assert time.monotonic() - start >= 0.25
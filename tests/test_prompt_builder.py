@@ -0,0 +1,72 @@
+import math
+import pandas as pd
+import pytest
+from ada import prompt_builder
+from ada.prompt_builder import PromptBuilder, count_tokens, estimate_tokens
+
+MODEL = "text-davinci-003"
+
+
+def sample_table() -> str:
+    df = pd.DataFrame(
+        {
+            "year": range(2006, 2017),
+            "avg_rating": [6.2 + i * 0.0731 for i in range(11)],
+            "revenue (millions)": [123.456 * (i + 1) for i in range(11)],
+            "title": ["Guardians of the Galaxy", "Prometheus", "Split"] * 3
+            + ["Sing", "Suicide Squad"],
+        }
+    )
+    return "\n" + df.to_markdown()
+
+
+SAMPLES = [
+    sample_table(),
+    "SELECT year, avg(rating) AS r FROM imdb_movies_data GROUP BY year ORDER BY 1",
+    "0.734635,0.129931,0.998812,0.000117,12345678901234567890",
+]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_estimate_takes_at_least_a_token_per_two_bytes(text):
+    assert estimate_tokens(text) >= math.ceil(len(text.encode("utf8")) / 2)
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_estimate_never_undercounts(text):
+    tiktoken = pytest.importorskip("tiktoken")
+    try:
+        encoding = tiktoken.encoding_for_model(MODEL)
+    except Exception:
+        pytest.skip("The tokenizer could not be loaded")
+    assert estimate_tokens(text) >= len(encoding.encode(text))
+
+
+def test_prompt_that_fits_is_unchanged():
+    builder = PromptBuilder("Question: q\nThought:", max_tokens=4_000, model=MODEL)
+    builder.add_text(" step\nAction: FooBar DB\nAction Input: q")
+    builder.add_observation(sample_table())
+    assert builder.build() == (
+        "Question: q\nThought: step\nAction: FooBar DB\nAction Input: q"
+        "\nObservation: " + sample_table() + "\nThought:"
+    )
+
+
+def test_observations_are_shortened_to_fit(monkeypatch):
+    monkeypatch.setattr(prompt_builder, "_encoding", lambda model: None)
+    builder = PromptBuilder(
+        "Question: q\nThought:",
+        max_tokens=600,
+        model=MODEL,
+        max_old_observation_tokens=50,
+    )
+    for i in range(4):
+        builder.add_text(f" step {i}\nAction: FooBar DB\nAction Input: q")
+        builder.add_observation(sample_table())
+    prompt = builder.build()
+    assert count_tokens(prompt, MODEL) <= 600
+    # The steps of the model are kept and the latest observation is kept longest
+    for i in range(4):
+        assert f" step {i}\n" in prompt
+    assert prompt.count(prompt_builder.OMITTED) >= 1
+    assert prompt.rstrip().endswith(prompt_builder.TRUNCATED.strip() + "\nThought:")
@@ -0,0 +1,61 @@
+import pyarrow as pa
+import pytest
+from ada.result_cache import ResultCache, ResultStore, is_cacheable, is_query
+
+TABLE = pa.table({"year": [2006, 2007, 2008], "n": [44, 53, 52]})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(tmp_path / "results")
+
+
+def test_results_are_keyed_by_normalized_sql_and_fingerprint(cache):
+    cache.set("SELECT year,\n  n FROM t;", "v1", TABLE)
+    assert cache.get("SELECT year, n FROM t", "v1").equals(TABLE)
+    assert cache.get("SELECT year, n FROM t", "v2") is None
+    # Whitespace in string literals is significant
+    cache.set("SELECT 'a  b'", "v1", TABLE)
+    assert cache.get("SELECT 'a b'", "v1") is None
+
+
+def test_only_deterministic_queries_are_cached(cache):
+    cache.set("SELECT random() AS r", "v1", TABLE)
+    assert cache.get("SELECT random() AS r", "v1") is None
+    assert not is_cacheable("SELECT now()")
+    assert not is_cacheable("CREATE TABLE t AS SELECT 1")
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "select 1",
+        "WITH t AS (SELECT 1) SELECT * FROM t",
+        "-- Movies per year\nSELECT year FROM t",
+        "/* Movies\n per year */ SELECT year FROM t",
+        "((SELECT 1) UNION (SELECT 2))",
+    ],
+)
+def test_queries(sql):
+    assert is_query(sql)
+    assert is_cacheable(sql)
+
+
+@pytest.mark.parametrize(
+    "sql", ["DROP TABLE t", "-- SELECT\nDELETE FROM t", "/* unterminated SELECT"]
+)
+def test_not_queries(sql):
+    assert not is_query(sql)
+
+
+def test_result_store_ids_are_hashes_of_the_result(tmp_path):
+    store = ResultStore(tmp_path / "store")
+    result_id = store.put(TABLE)
+    assert store.put(pa.table({"year": [2006, 2007, 2008], "n": [44, 53, 52]})) == (
+        result_id
+    )
+    assert store.put(TABLE.slice(1)) != result_id
+    assert len(list((tmp_path / "store").glob("*.arrow"))) == 2
+    assert store.get(result_id).equals(TABLE)
+    assert store.get(result_id, max_rows=2).num_rows == 2
+    assert store.get("missing") is None
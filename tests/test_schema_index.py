@@ -0,0 +1,13 @@
+from ada.schema_index import SchemaIndex
+
+
+def test_rank_tables_without_terms():
+    index = SchemaIndex({"a": [], "b": []})
+    assert index.rank("movies by year", k=1) == ["a"]
+
+
+def test_rank_most_relevant_first():
+    index = SchemaIndex(
+        {"sales": ["sales", "region", "amount"], "movies": ["movies", "year", "title"]}
+    )
+    assert index.rank("Which movies came out each year?", k=1) == ["movies"]
@@ -0,0 +1,28 @@
+import json
+import os
+from ada.tracing import Metrics, Tracer
+
+
+def test_spans_are_written_to_a_file_per_process(tmp_path):
+    tracer = Tracer(Metrics(tmp_path / "metrics"), trace_file=tmp_path / "traces.jsonl")
+    with tracer.span("question"):
+        with tracer.span("sql", num_rows=3):
+            pass
+    lines = (tmp_path / f"traces.{os.getpid()}.jsonl").read_text().splitlines()
+    sql, question = map(json.loads, lines)
+    assert sql["parent_id"] == question["span_id"]
+    assert sql["attributes"] == dict(num_rows=3)
+
+
+def test_trace_files_are_rotated(tmp_path):
+    tracer = Tracer(
+        Metrics(tmp_path / "metrics"),
+        trace_file=tmp_path / "traces.jsonl",
+        max_bytes=1_000,
+    )
+    for _ in range(100):
+        with tracer.span("sql"):
+            pass
+    files = sorted(p.name for p in tmp_path.glob("traces.*"))
+    assert files == [f"traces.{os.getpid()}.jsonl", f"traces.{os.getpid()}.jsonl.1"]
+    assert all((tmp_path / name).stat().st_size < 2_000 for name in files)